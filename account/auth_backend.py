@@ -1,11 +1,45 @@
+from django.conf import settings
 from django.contrib.auth.backends import BaseBackend
 from django.contrib.auth.hashers import check_password
+from django.core.cache import caches
 from account.models import LoginCreds
 
 import logging
 
 logger = logging.getLogger('accounts')
 
+
+def user_cache_key(username):
+    return f"login_creds:{username}"
+
+
+def user_cache():
+    return caches[settings.AUTH_USER_CACHE['alias']]
+
+
+# the LoginCreds fields kept in the cache, never the password or its hash
+CACHED_USER_FIELDS = ('username', 'name', 'last_login', 'is_active', 'is_staff')
+
+
+def _cache_entry(user):
+    return {'fields': {field: getattr(user, field) for field in CACHED_USER_FIELDS},
+            'session_auth_hashes': [user.get_session_auth_hash(), *user.get_session_auth_fallback_hash()]}
+
+
+def _cached_user(entry):
+    # the other fields are deferred: reading them queries the db, save() leaves them alone
+    fields = entry['fields']
+    user = LoginCreds.from_db('default', list(fields), [fields[field.attname] for field in LoginCreds._meta.concrete_fields
+                                                       if field.attname in fields])
+    user.cached_session_auth_hashes = entry['session_auth_hashes']
+    return user
+
+
+def forget_users(usernames):
+    """Drop cached users, for changes that don't send post_save (update(), bulk_update())."""
+    user_cache().delete_many([user_cache_key(username) for username in usernames])
+
+
 class CustomUserAuthBackend(BaseBackend):
     def authenticate(self, request, username=None, password=None, **kwargs):
         try:
@@ -16,7 +50,13 @@ class CustomUserAuthBackend(BaseBackend):
             return None
 
     def get_user(self, user_id):
+        # runs on every authenticated request: served from the cache, see account/signals.py
+        entry = user_cache().get(user_cache_key(user_id))
+        if entry is not None:
+            return _cached_user(entry)
         try:
-            return LoginCreds.objects.get(pk=user_id)
+            user = LoginCreds.objects.get(pk=user_id)
         except LoginCreds.DoesNotExist:
             return None
+        user_cache().set(user_cache_key(user_id), _cache_entry(user), timeout=settings.AUTH_USER_CACHE['ttl'])
+        return user
@@ -0,0 +1,75 @@
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from django.contrib.auth.hashers import identify_hasher, make_password
+from django.core.management.base import BaseCommand
+
+from account.auth_backend import forget_users
+from account.models import LoginCreds
+
+logger = logging.getLogger('accounts')
+
+
+def needs_hash(user, force=False):
+    """True unless hashed_password is already a hash made with the current hasher settings."""
+    if force or not user.hashed_password:
+        return True
+    try:
+        return identify_hasher(user.hashed_password).must_update(user.hashed_password)
+    except ValueError:
+        return True
+
+
+class Command(BaseCommand):
+    help = "Hash the plain passwords of LoginCreds into hashed_password, skipping rows that are already hashed."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help="Rows hashed and written per bulk_update.")
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help="Hashing processes, 1 hashes in this process.")
+        parser.add_argument('--force', action='store_true',
+                            help="Rehash every row, also the ones that are already hashed.")
+
+    def handle(self, *args, batch_size, workers, force, **options):
+        # PBKDF2 is CPU bound: hashed in a process pool. The executor only forks its workers
+        # on the first task, so one is run here, before users.iterator() opens its server-side
+        # cursor, and no worker inherits it (with fork, all the workers start on that first task)
+        pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+        if pool:
+            pool.submit(int).result()
+            hash_many = partial(pool.map, make_password, chunksize=max(1, batch_size // (workers * 4)))
+        else:
+            hash_many = partial(map, make_password)
+        users = LoginCreds.objects.only('username', 'password', 'hashed_password').order_by('username')
+
+        hashed = skipped = 0
+        batch = []
+        try:
+            for user in users.iterator(chunk_size=batch_size):
+                if not needs_hash(user, force):
+                    skipped += 1
+                    continue
+                batch.append(user)
+                if len(batch) == batch_size:
+                    hashed += self._write(batch, hash_many)
+                    batch = []
+            hashed += self._write(batch, hash_many)
+        finally:
+            if pool:
+                pool.shutdown()
+
+        logger.info(f"hash_passwords: {hashed} hashed, {skipped} already hashed")
+        self.stdout.write(f"{hashed} passwords hashed, {skipped} already hashed")
+
+    def _write(self, batch, hash_many):
+        if not batch:
+            return 0
+        for user, hashed_password in zip(batch, hash_many([user.password for user in batch])):
+            user.hashed_password = hashed_password
+        LoginCreds.objects.bulk_update(batch, ['hashed_password'])
+        # bulk_update sends no post_save
+        forget_users([user.username for user in batch])
+        return len(batch)
@@ -27,5 +27,19 @@ class LoginCreds(AbstractBaseUser, PermissionsMixin):
         managed = True
         db_table = '"dwh_system"."cat_login_creds"'
 
+    # set on the users account.auth_backend serves from the cache, which has no password:
+    # the session hash and its SECRET_KEY_FALLBACKS variants, computed when it was cached
+    cached_session_auth_hashes = None
+
+    def get_session_auth_hash(self):
+        if self.cached_session_auth_hashes is not None:
+            return self.cached_session_auth_hashes[0]
+        return super().get_session_auth_hash()
+
+    def get_session_auth_fallback_hash(self):
+        if self.cached_session_auth_hashes is not None:
+            return iter(self.cached_session_auth_hashes[1:])
+        return super().get_session_auth_fallback_hash()
+
     def __str__(self):
         return self.username
\ No newline at end of file
@@ -0,0 +1,11 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from account.auth_backend import forget_users
+from account.models import LoginCreds
+
+
+@receiver(post_save, sender=LoginCreds)
+@receiver(post_delete, sender=LoginCreds)
+def forget_cached_user(sender, instance, **kwargs):
+    forget_users([instance.username])
@@ -1,7 +1,12 @@
-from django.test import TestCase, Client
+from django.test import TestCase, Client, override_settings
+from django.utils import timezone
 from django.urls import reverse
 from unittest.mock import patch, MagicMock
 from django.contrib.auth import get_user_model
+from account.auth_backend import CustomUserAuthBackend, forget_users, user_cache, user_cache_key
+from io import StringIO
+from django.contrib.auth.hashers import check_password, make_password
+from django.core.management import call_command
 from django.conf import settings # Required for checking if settings.LOGIN_REDIRECT_URL is used
 
 # Use Django's User model if appropriate, or a custom one if your project uses it.
@@ -72,3 +77,83 @@ class LoginViewTests(TestCase):
         self.assertEqual(response.status_code, 200)
         # Based on `account/templates/account/pages-login.html`
         self.assertTemplateUsed(response, 'account/pages-login.html')
+
+
+@override_settings(CACHES={**settings.CACHES, 'auth': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                                                       'LOCATION': 'auth-tests'}})
+class CachedUserTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='cached', name='cached', last_login=timezone.now())
+        self.backend = CustomUserAuthBackend()
+
+    def test_user_is_served_from_the_cache(self):
+        self.backend.get_user('cached')
+
+        with self.assertNumQueries(0):
+            self.assertEqual(self.backend.get_user('cached').name, 'cached')
+
+    def test_password_is_not_cached(self):
+        self.user.password = 'plain-secret'
+        self.user.hashed_password = make_password('plain-secret')
+        self.user.save()
+        self.backend.get_user('cached')
+
+        entry = user_cache().get(user_cache_key('cached'))
+        self.assertNotIn('plain-secret', repr(entry))
+        self.assertNotIn(self.user.hashed_password, repr(entry))
+        with self.assertNumQueries(0):
+            cached = self.backend.get_user('cached')
+            # what django checks the session against on every request
+            self.assertEqual(cached.get_session_auth_hash(), self.user.get_session_auth_hash())
+
+    def test_session_is_verified_against_the_cached_user(self):
+        client = Client()
+        client.force_login(self.user)
+
+        # the second request is served from the cache: still logged in (404, not a login redirect)
+        for _ in range(2):
+            self.assertEqual(client.get(reverse('search:history_sql', args=['missing'])).status_code, 404)
+
+    def test_saving_the_user_drops_it_from_the_cache(self):
+        self.backend.get_user('cached')
+        self.user.name = 'renamed'
+        self.user.save()
+
+        with self.assertNumQueries(1):
+            self.assertEqual(self.backend.get_user('cached').name, 'renamed')
+
+    def test_bulk_changes_are_dropped_explicitly(self):
+        self.backend.get_user('cached')
+        User.objects.filter(username='cached').update(name='bulk')
+
+        self.assertEqual(self.backend.get_user('cached').name, 'cached')
+        forget_users(['cached'])
+        self.assertEqual(self.backend.get_user('cached').name, 'bulk')
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class HashPasswordsCommandTests(TestCase):
+
+    def setUp(self):
+        self.plain = User.objects.create(username='plain', name='plain', password='secret',
+                                         hashed_password='', last_login=timezone.now())
+        self.hashed = User.objects.create(username='hashed', name='hashed', password='other',
+                                          hashed_password=make_password('other'), last_login=timezone.now())
+
+    def test_hashes_plain_rows_only(self):
+        previous = self.hashed.hashed_password
+        out = StringIO()
+        call_command('hash_passwords', workers=1, batch_size=1, stdout=out)
+
+        self.plain.refresh_from_db()
+        self.hashed.refresh_from_db()
+        self.assertTrue(check_password('secret', self.plain.hashed_password))
+        self.assertEqual(self.hashed.hashed_password, previous)
+        self.assertIn("1 passwords hashed, 1 already hashed", out.getvalue())
+
+    def test_process_pool(self):
+        call_command('hash_passwords', workers=2, force=True, stdout=StringIO())
+
+        self.hashed.refresh_from_db()
+        self.assertTrue(check_password('other', self.hashed.hashed_password))
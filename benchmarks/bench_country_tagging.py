@@ -0,0 +1,89 @@
+"""
+Micro-benchmark of country tagging of per-country results.
+
+Compares the old `df.copy()` + column assignment + reindex tagging of pandas
+frames with the copy-free Arrow single-value dictionary arrays that
+search.multiprocessing tags every fetched batch with.
+
+    python benchmarks/bench_country_tagging.py --rows 5000000 --columns 10
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+import django
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'catopus.settings')
+django.setup()
+
+from search.config import map_country_code_to_id as code_to_id
+from search.multiprocessing import country_tag_arrays
+
+
+def old_tag_country_frame(df, db_name):
+    columns = list(df.columns)
+    copy_df = df.copy()
+    copy_df['_country_code'] = db_name
+    copy_df['_country_id'] = code_to_id[db_name]
+    return copy_df[['_country_id', '_country_code', *columns]]
+
+
+def old_country_tag_arrays(db_name, length):
+    return (pa.array(np.full(length, code_to_id[db_name], np.int64)),
+            pa.array([db_name] * length, pa.string()))
+
+
+def measure_pandas(func, df, db_name):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(df, db_name)
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return seconds, peak, result
+
+
+def measure_arrow(func, db_name, length):
+    # arrow's own memory pool + python/numpy allocations
+    allocated = pa.total_allocated_bytes()
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(db_name, length)
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return seconds, pa.total_allocated_bytes() - allocated + peak, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=5_000_000)
+    parser.add_argument('--columns', type=int, default=10)
+    parser.add_argument('--country', default='de')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    data = {f"col_{i}": rng.random(args.rows) for i in range(args.columns)}
+
+    print(f"{args.rows:,} rows x {args.columns} float columns, tagging as '{args.country}'\n")
+    print(f"{'variant':<34}{'time, s':>10}{'allocated, MB':>16}")
+
+    rows = [
+        ('pandas: copy + assign + reindex', measure_pandas(old_tag_country_frame, pd.DataFrame(data), args.country)),
+        ('arrow: materialized columns', measure_arrow(old_country_tag_arrays, args.country, args.rows)),
+        ('arrow: dictionary over shared buf', measure_arrow(country_tag_arrays, args.country, args.rows)),
+        # the shared buffer is already big enough for every next batch/country
+        ('arrow: dictionary, buffer reused', measure_arrow(country_tag_arrays, args.country, args.rows)),
+    ]
+    for name, (seconds, allocated, _) in rows:
+        print(f"{name:<34}{seconds:>10.3f}{allocated / 2 ** 20:>16.1f}")
+
+
+if __name__ == '__main__':
+    main()
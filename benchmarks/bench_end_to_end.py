@@ -0,0 +1,358 @@
+"""
+End-to-end and per-stage benchmark of the search pipeline against local databases.
+
+Creates N databases on a local postgres server, named like the first country codes of
+search.config.connection_info and spread over its clusters the same way, each with a
+synthetic `bench_jobs` table of --rows rows. The country connections then point at that
+server (REMOTE_DB_USER/REMOTE_DB_PASSWORD must be valid there), the dwh is the one in
+settings.DATABASES, which needs the catopus schema and the search migrations.
+
+End to end: run_select, _handle_query_execution, save_table_to_db, run_sql_query_remotely.
+Stages (on the first country): fetch, tag, concat, parquet, html, columns, to_sql.
+
+Writes a JSON report (timings of every repeat plus environment) that can be compared
+with the one of another version:
+
+    python benchmarks/bench_end_to_end.py --countries 8 --rows 200000
+    python benchmarks/bench_end_to_end.py --countries 8 --rows 200000 --compare benchmarks/reports/<old>.json
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from io import BytesIO
+from unittest.mock import patch
+
+import django
+import pandas as pd
+import psycopg2
+import pyarrow as pa
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'catopus.settings')
+django.setup()
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.serializers.json import DjangoJSONEncoder
+from django.test import RequestFactory
+from django.test.utils import override_settings
+from django.utils import timezone
+from psycopg2 import sql
+
+from catopus.utils.database import copy_to_db, get_dwh_engine, get_pooled_engine
+from search.config import connection_info
+from search.models import RemoteCountryProgress, RemoteLogs, SearchResult
+from search.multiprocessing import concat_batches, country_status, rows_to_record_batch, run_select
+from search.results import ResultSpool, table_to_columns, write_result_table
+from search.tasks import run_sql_query_remotely
+from search.views import _handle_query_execution, _render_table_html, save_table_to_db
+
+BENCH_TABLE = 'bench_jobs'
+BENCH_QUERY = f'SELECT * FROM {BENCH_TABLE}'
+
+# generate_series keeps the data generation on the server
+CREATE_TABLE = f"""
+DROP TABLE IF EXISTS {BENCH_TABLE};
+CREATE TABLE {BENCH_TABLE} AS
+SELECT i AS id,
+       (random() * 10000000)::bigint AS user_id,
+       (random() * 10)::int AS clicks,
+       round((random() * 100)::numeric, 2) AS revenue,
+       timestamp '2024-01-01' + random() * interval '365 days' AS created_at,
+       (ARRAY['organic', 'paid', 'email', 'referral', 'direct'])[1 + (i %% 5)] AS source,
+       'Job title ' || (i %% 5000) AS title
+FROM generate_series(1, %s) AS i;
+"""
+
+
+def local_topology(countries, host, port):
+    """connection_info with the first `countries` dbs, taken round robin over the clusters."""
+    clusters = {cluster: list(info['dbs']) for cluster, info in connection_info.items()}
+    topology = {cluster: {'host': host, 'port': port, 'dbs': []} for cluster in clusters}
+    position = 0
+    while sum(len(info['dbs']) for info in topology.values()) < countries:
+        for cluster, dbs in clusters.items():
+            if position < len(dbs) and sum(len(info['dbs']) for info in topology.values()) < countries:
+                topology[cluster]['dbs'].append(dbs[position])
+        position += 1
+        if all(position >= len(dbs) for dbs in clusters.values()):
+            break
+    return {cluster: info for cluster, info in topology.items() if info['dbs']}
+
+
+def set_up_databases(topology, rows, recreate, host, port):
+    # the databases are created on the same server the country connections go to
+    maintenance = psycopg2.connect(host=host, port=port, dbname='postgres',
+                                   user=settings.REMOTE_DB_USER, password=settings.REMOTE_DB_PASSWORD)
+    maintenance.autocommit = True
+    try:
+        with maintenance.cursor() as cursor:
+            for info in topology.values():
+                for db_name in info['dbs']:
+                    cursor.execute("SELECT 1 FROM pg_database WHERE datname = %s", (db_name,))
+                    if cursor.fetchone() is None:
+                        cursor.execute(sql.SQL('CREATE DATABASE {}').format(sql.Identifier(db_name)))
+                    elif not recreate and _table_rows(info['host'], info['port'], db_name) == rows:
+                        continue
+
+                    connection = get_pooled_engine(info['host'], db_name, settings.REMOTE_DB_USER,
+                                                   settings.REMOTE_DB_PASSWORD, info['port']).raw_connection()
+                    try:
+                        with connection.cursor() as db_cursor:
+                            db_cursor.execute(CREATE_TABLE, (rows,))
+                        connection.commit()
+                    finally:
+                        connection.close()
+                    print(f"  {db_name}: {rows:,} rows")
+    finally:
+        maintenance.close()
+
+
+def _table_rows(host, port, db_name):
+    connection = get_pooled_engine(host, db_name, settings.REMOTE_DB_USER, settings.REMOTE_DB_PASSWORD, port).raw_connection()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT to_regclass(%s) IS NOT NULL", (BENCH_TABLE,))
+            if not cursor.fetchone()[0]:
+                return None
+            cursor.execute(f"SELECT count(*) FROM {BENCH_TABLE}")
+            return cursor.fetchone()[0]
+    finally:
+        connection.close()
+
+
+def _drop_dwh_table(table_name):
+    connection = get_dwh_engine().raw_connection()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(sql.SQL('DROP TABLE IF EXISTS {}.{}').format(sql.Identifier('catopus'), sql.Identifier(table_name)))
+        connection.commit()
+    finally:
+        connection.close()
+
+
+class Report:
+    def __init__(self, args):
+        self.results = {}
+        self.meta = {
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'commit': _git_commit(),
+            'python': platform.python_version(),
+            'pyarrow': pa.__version__,
+            'pandas': pd.__version__,
+            'django': django.get_version(),
+            'args': vars(args),
+        }
+
+    def measure(self, name, function, repeat, rows=None):
+        seconds = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = function()
+            seconds.append(time.perf_counter() - start)
+        self.results[name] = {'seconds': seconds,
+                              'median': statistics.median(seconds),
+                              'min': min(seconds),
+                              'rows': rows}
+        print(f"  {name:<28}{statistics.median(seconds):>10.3f}{min(seconds):>10.3f}")
+        return result
+
+    def write(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as report_file:
+            json.dump({**self.meta, 'results': self.results}, report_file, indent=2)
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _close_result(result):
+    # a spool when some country finished, a placeholder table when none did, None on errors
+    if hasattr(result, 'close'):
+        result.close()
+
+
+def _select_outcome(result):
+    if result is None:
+        return 0, ['all']
+    status = country_status(result)
+    # the placeholder table has one 'None' row, not a result row
+    rows = result.num_rows if isinstance(result, ResultSpool) else 0
+    return rows, sorted({**status['failed'], **status['timed_out']})
+
+
+def bench_end_to_end(report, countries, total_rows, repeat):
+    user, _ = get_user_model().objects.get_or_create(
+        username='benchmark', defaults={'name': 'benchmark', 'last_login': timezone.now()})
+
+    def select():
+        result = run_select(BENCH_QUERY, countries)
+        outcome = _select_outcome(result)
+        _close_result(result)
+        return outcome
+
+    result_rows, failed = report.measure('run_select', select, repeat, total_rows)
+    report.results['run_select'].update(result_rows=result_rows, failed_countries=failed)
+    if failed or result_rows == 0:
+        print(f"  run_select returned {result_rows:,} rows, failed or timed out countries: {', '.join(failed) or '-'}")
+
+    factory = RequestFactory()
+
+    def handle_query_execution():
+        request = factory.post('/', {'query': BENCH_QUERY, 'force_refresh': '1'})
+        request.user = user
+        return _handle_query_execution(request, BENCH_QUERY, countries, 'benchmark')
+
+    report.measure('handle_query_execution', handle_query_execution, repeat, total_rows)
+    SearchResult.objects.filter(user=user).delete()
+
+    result_spool = run_select(BENCH_QUERY, countries)
+    table_names = []
+
+    def save_table():
+        # save_table_to_db suffixes the name with a timestamp (seconds): unique names per repeat
+        table_names.append(save_table_to_db(result_spool.to_batches(), f"bench_save_{uuid.uuid4().hex[:6]}"))
+
+    if result_spool is None:
+        print("  save_table_to_db skipped, run_select failed")
+    else:
+        report.measure('save_table_to_db', save_table, repeat, total_rows)
+        _close_result(result_spool)
+    for table_name in table_names:
+        _drop_dwh_table(table_name)
+
+    def remote_run():
+        log_remote = RemoteLogs.objects.create(user=user, status='queued', sql_query=BENCH_QUERY,
+                                               countries_list='benchmark', countries=countries)
+        RemoteCountryProgress.objects.bulk_create(
+            RemoteCountryProgress(remote_log=log_remote, country=country) for country in countries)
+        run_sql_query_remotely(log_remote.id)
+        log_remote.refresh_from_db()
+        if log_remote.status != 'finished':
+            raise RuntimeError(f"remote run {log_remote.id} ended with {log_remote.status}: {log_remote.log_field}")
+        _drop_dwh_table(log_remote.table_name_created)
+        log_remote.delete()
+
+    report.measure('run_sql_query_remotely', remote_run, repeat, total_rows)
+
+
+def bench_stages(report, topology, repeat):
+    cluster, info = next(iter(topology.items()))
+    db_name = info['dbs'][0]
+    batch_size = settings.SEARCH_FETCH_BATCH_SIZE
+
+    def fetch():
+        connection = get_pooled_engine(info['host'], db_name, settings.REMOTE_DB_USER,
+                                       settings.REMOTE_DB_PASSWORD, info['port']).raw_connection()
+        try:
+            cursor = connection.cursor(name=f"bench_{uuid.uuid4().hex}")
+            cursor.itersize = batch_size
+            cursor.execute(BENCH_QUERY)
+            chunks = []
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                chunks.append(rows)
+            description = cursor.description
+            cursor.close()
+            return chunks, description
+        finally:
+            connection.close()
+
+    chunks, description = report.measure('stage.fetch', fetch, repeat)
+    rows = sum(len(chunk) for chunk in chunks)
+    report.results['stage.fetch']['rows'] = rows
+
+    batches = report.measure('stage.tag', lambda: [rows_to_record_batch(chunk, description, db_name) for chunk in chunks],
+                             repeat, rows)
+    table = report.measure('stage.concat', lambda: concat_batches(batches), repeat, rows)
+
+    def parquet():
+        buffer = BytesIO()
+        write_result_table(table, buffer)
+        return buffer
+
+    report.measure('stage.parquet', parquet, repeat, rows)
+    report.measure('stage.html', lambda: _render_table_html(table.slice(0, settings.SEARCH_RESULT_PAGE_SIZE)),
+                   repeat, min(rows, settings.SEARCH_RESULT_PAGE_SIZE))
+
+    report.measure('stage.columns', lambda: json.dumps(
+        table_to_columns(table.slice(0, settings.SEARCH_RESULT_PAGE_SIZE), 0, rows), cls=DjangoJSONEncoder),
+        repeat, min(rows, settings.SEARCH_RESULT_PAGE_SIZE))
+
+    table_names = []
+
+    def to_sql():
+        table_names.append(f"bench_stage_{uuid.uuid4().hex[:8]}")
+        copy_to_db(table.to_batches(), table_names[-1], schema='catopus')
+
+    report.measure('stage.to_sql', to_sql, repeat, rows)
+    for table_name in table_names:
+        _drop_dwh_table(table_name)
+
+
+def compare(report, baseline_path):
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)
+    print(f"\ncompared with {baseline_path} (commit {baseline.get('commit')})")
+    print(f"  {'benchmark':<28}{'before, s':>10}{'after, s':>10}{'ratio':>8}")
+    for name, result in report.results.items():
+        before = baseline['results'].get(name)
+        if before:
+            print(f"  {name:<28}{before['median']:>10.3f}{result['median']:>10.3f}{result['median'] / before['median']:>8.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--countries', type=int, default=4)
+    parser.add_argument('--rows', type=int, default=100_000, help='rows per country')
+    parser.add_argument('--host', default=settings.DATABASES['default']['HOST'], help='local postgres for the country dbs')
+    parser.add_argument('--port', type=int, default=5432)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--recreate', action='store_true', help='rebuild the bench tables even if they have --rows rows')
+    parser.add_argument('--skip-end-to-end', action='store_true')
+    parser.add_argument('--report', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'reports',
+                                                         f"{time.strftime('%Y%m%d_%H%M%S')}.json"))
+    parser.add_argument('--compare', help='report of an earlier run to compare medians with')
+    args = parser.parse_args()
+
+    topology = local_topology(args.countries, args.host, args.port)
+    countries = [db_name for info in topology.values() for db_name in info['dbs']]
+    print(f"{len(countries)} countries over {len(topology)} clusters: "
+          + ', '.join(f"{cluster}={info['dbs']}" for cluster, info in topology.items()))
+    set_up_databases(topology, args.rows, args.recreate, args.host, args.port)
+
+    report = Report(args)
+    media_root = tempfile.mkdtemp(prefix='catopus_bench_')
+    print(f"\n  {'benchmark':<28}{'median, s':>10}{'min, s':>10}")
+    try:
+        # the code under test reads the topology from the shared connection_info dict
+        with patch.dict(connection_info, topology, clear=True), override_settings(MEDIA_ROOT=media_root):
+            if not args.skip_end_to_end:
+                bench_end_to_end(report, countries, args.rows * len(countries), args.repeat)
+            bench_stages(report, topology, args.repeat)
+    finally:
+        shutil.rmtree(media_root, ignore_errors=True)
+
+    report.write(args.report)
+    print(f"\nreport: {args.report}")
+    if args.compare:
+        compare(report, args.compare)
+
+
+if __name__ == '__main__':
+    main()
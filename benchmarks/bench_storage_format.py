@@ -0,0 +1,94 @@
+"""
+Benchmark of the parquet storage format of saved search results.
+
+Writes the same result with every codec and reports write time, full read time,
+first page read time (what the result viewer does) and file size.
+
+    python benchmarks/bench_storage_format.py --rows 2000000
+    python benchmarks/bench_storage_format.py --file search_result_df/search_results/<identifier>.parquet
+"""
+import argparse
+import os
+import sys
+import time
+from io import BytesIO
+
+import django
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'catopus.settings')
+django.setup()
+
+from search.config import map_country_code_to_id as code_to_id
+from search.multiprocessing import country_tag_arrays
+from search.results import CODECS, read_result_page, write_result_table
+
+
+def synthetic_result(rows, countries=10):
+    """A result shaped like a typical "all countries" SELECT: ids, counters, money, dates and text."""
+    rng = np.random.default_rng(0)
+    per_country = rows // countries
+    tables = []
+    for db_name in list(code_to_id)[:countries]:
+        country_id, country_code = country_tag_arrays(db_name, per_country)
+        tables.append(pa.table({
+            '_country_id': country_id,
+            '_country_code': country_code,
+            'id': np.arange(per_country, dtype=np.int64),
+            'user_id': rng.integers(0, 10_000_000, per_country),
+            'clicks': rng.poisson(3, per_country),
+            'revenue': np.round(rng.exponential(2.5, per_country), 2),
+            'created_at': pa.array(np.datetime64('2024-01-01') + rng.integers(0, 365 * 86400, per_country).astype('timedelta64[s]'),
+                                   pa.timestamp('us', tz='UTC')),
+            'source': pa.array(rng.choice(['organic', 'paid', 'email', 'referral', 'direct'], per_country)),
+            'title': pa.array([f"Job title {i % 5000}" for i in range(per_country)]),
+        }))
+    return pa.concat_tables(tables)
+
+
+def run(table, codec, row_group_size, repeat):
+    storage = {'compression': codec, 'row_group_size': row_group_size}
+
+    write_times, read_times, page_times = [], [], []
+    for _ in range(repeat):
+        buffer = BytesIO()
+        start = time.perf_counter()
+        write_result_table(table, buffer, storage)
+        write_times.append(time.perf_counter() - start)
+
+        buffer.seek(0)
+        start = time.perf_counter()
+        pq.read_table(buffer)
+        read_times.append(time.perf_counter() - start)
+
+        buffer.seek(0)
+        start = time.perf_counter()
+        read_result_page(pq.ParquetFile(buffer), 0, 500)
+        page_times.append(time.perf_counter() - start)
+
+    return min(write_times), min(read_times), min(page_times), buffer.getbuffer().nbytes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--file', help='benchmark on a stored result instead of synthetic data')
+    parser.add_argument('--row-group-size', type=int, default=100_000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    table = pq.read_table(args.file) if args.file else synthetic_result(args.rows)
+    print(f"{table.num_rows:,} rows x {table.num_columns} columns, "
+          f"{table.nbytes / 2 ** 20:.1f} MB in memory, row groups of {args.row_group_size:,}\n")
+    print(f"{'codec':<8}{'write, s':>10}{'read, s':>10}{'page, s':>10}{'size, MB':>10}")
+
+    for codec in CODECS:
+        write, read, page, size = run(table, codec, args.row_group_size, args.repeat)
+        print(f"{codec:<8}{write:>10.3f}{read:>10.3f}{page:>10.3f}{size / 2 ** 20:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
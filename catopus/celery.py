@@ -1,10 +1,19 @@
 from __future__ import absolute_import
 import os
 from celery import Celery
+from celery.signals import worker_process_init
 from django.conf import settings
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'catopus.settings')
 
 app = Celery('catopus')
 app.config_from_object('django.conf:settings', namespace='CELERY')
-app.autodiscover_tasks(lambda: settings.INSTALLED_APPS)
\ No newline at end of file
+app.autodiscover_tasks(lambda: settings.INSTALLED_APPS)
+
+
+@worker_process_init.connect
+def warm_up_db_pools(**kwargs):
+    if settings.REMOTE_DB_WARMUP:
+        from catopus.utils.database import warm_up_remote_engines
+
+        warm_up_remote_engines()
@@ -215,4 +215,138 @@ CELERY_BROKER_URL = 'redis://localhost:6379'
 CELERY_RESULT_BACKEND = 'redis://localhost:6379'
 CELERY_ACCEPT_CONTENT = ['application/json']
 CELERY_RESULT_SERIALIZER = 'json'
-CELERY_TASK_SERIALIZER = 'json'
\ No newline at end of file
+CELERY_TASK_SERIALIZER = 'json'
+
+# Long-lived connection pools, one engine per (host, db), see catopus/utils/database.py
+DB_ENGINE_REGISTRY = {
+    'remote': {
+        'pool_size': env.int('REMOTE_DB_POOL_SIZE', default=2),
+        'max_overflow': env.int('REMOTE_DB_POOL_OVERFLOW', default=2),
+        'pool_recycle': env.int('REMOTE_DB_POOL_RECYCLE', default=1800),
+        'pool_pre_ping': True,
+        'idle_timeout': env.int('REMOTE_DB_POOL_IDLE_TIMEOUT', default=900),
+    },
+    'dwh': {
+        'pool_size': 5,
+        'max_overflow': 10,
+        'pool_recycle': 1800,
+        'pool_pre_ping': True,
+        'idle_timeout': None,
+    },
+}
+
+# Open a connection to every country db when a gunicorn/celery worker starts
+REMOTE_DB_WARMUP = env.bool('REMOTE_DB_WARMUP', default=False)
+
+# Per-cluster concurrency of the country fan-out (AIMD), see search/scheduler.py
+SEARCH_CLUSTER_CONCURRENCY = {
+    'default': {'initial': 4, 'min_limit': 1, 'max_limit': 16},
+    'nl': {'initial': 8, 'max_limit': 24},
+    'us': {'initial': 6, 'max_limit': 16},
+}
+
+# Processes running country queries: gunicorn workers (gunicorn reads WEB_CONCURRENCY too)
+# and celery worker processes (CELERY_WORKER_CONCURRENCY is celery's worker_concurrency).
+# The limits above are per cluster for all of them together, each process gets an equal
+# share, at least min_limit, so a cluster never sees more than max(limit, processes * min_limit)
+WEB_CONCURRENCY = env.int('WEB_CONCURRENCY', default=1)
+CELERY_WORKER_CONCURRENCY = env.int('CELERY_WORKER_CONCURRENCY', default=2)
+SEARCH_CLUSTER_PROCESSES = WEB_CONCURRENCY + CELERY_WORKER_CONCURRENCY
+
+# Rows fetched per server-side cursor round trip for each country
+SEARCH_FETCH_BATCH_SIZE = env.int('SEARCH_FETCH_BATCH_SIZE', default=50000)
+
+# Load saved results through an UNLOGGED staging table renamed into place, see copy_to_db
+DWH_BULK_LOAD_STAGING = env.bool('DWH_BULK_LOAD_STAGING', default=False)
+
+# Rows rendered with a result and returned per request by the result_page endpoint
+SEARCH_RESULT_PAGE_SIZE = 500
+SEARCH_RESULT_MAX_PAGE_SIZE = 5000
+
+# Parquet format of stored search results (search_result_df/search_results/), see
+# benchmarks/bench_storage_format.py; older gzip files stay readable whatever is set here
+SEARCH_RESULT_STORAGE = {
+    'compression': env.str('SEARCH_RESULT_COMPRESSION', default='zstd'),  # zstd, snappy, lz4, gzip or none
+    'compression_level': None,
+    'row_group_size': 100_000,  # rows, also the unit of paging, exports and COPY loads
+    'use_dictionary': True,
+    'write_statistics': True,
+}
+
+# Caches: search_results maps a query fingerprint (normalized SQL + countries) to the
+# SearchResult that already holds its result. It, sessions and the users of
+# account.auth_backend are shared by all gunicorn workers in the redis celery runs on (its
+# db 1). Without REDIS_CACHE_URL sessions are only in the database, users are not cached and
+# each worker has its own result cache (least recently used entries are culled)
+REDIS_CACHE_URL = env.str('REDIS_CACHE_URL', default=None)
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'search_results': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': REDIS_CACHE_URL,
+        'KEY_PREFIX': 'search',
+    } if REDIS_CACHE_URL else {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'search-results',
+        'OPTIONS': {'MAX_ENTRIES': 1000},
+    },
+    'sessions': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': REDIS_CACHE_URL,
+        'KEY_PREFIX': 'session',
+    } if REDIS_CACHE_URL else {
+        'BACKEND': 'django.core.cache.backends.dummy.DummyCache',
+    },
+    'auth': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': REDIS_CACHE_URL,
+        'KEY_PREFIX': 'auth',
+    } if REDIS_CACHE_URL else {
+        'BACKEND': 'django.core.cache.backends.dummy.DummyCache',
+    },
+}
+
+# cached_db: sessions are read from redis and written through to the database, so a flushed
+# or evicted redis doesn't log everyone out
+SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db' if REDIS_CACHE_URL else 'django.contrib.sessions.backends.db'
+SESSION_CACHE_ALIAS = 'sessions'
+
+# LoginCreds cached by CustomUserAuthBackend.get_user, dropped when the row is saved/deleted
+AUTH_USER_CACHE = {
+    'alias': 'auth',
+    'ttl': 3600,
+}
+
+SEARCH_RESULT_CACHE = {
+    'alias': 'search_results',
+    'ttl': 300,  # seconds, overridable per query with the cache_ttl field, 0 disables
+    'max_ttl': 86400,
+}
+
+# Remote runs: country queries running at the same time in the celery task, and where
+# their per-country parquet files are written until they are loaded into the dwh
+REMOTE_MAX_WORKERS = env.int('REMOTE_MAX_WORKERS', default=8)
+REMOTE_SPILL_DIR = env.str('REMOTE_SPILL_DIR', default=None)
+# Load every country into the remote run's table as soon as it finishes, the table fills
+# up during the run; False loads all countries at the end in one transaction
+REMOTE_STREAMING_INGEST = env.bool('REMOTE_STREAMING_INGEST', default=True)
+
+# Query deadlines (seconds): the whole fan-out of a query page run, statements still running
+# on the countries when it passes are cancelled and the result is returned without them.
+# Remote runs have no deadline unless REMOTE_QUERY_TIMEOUT is set
+SEARCH_QUERY_TIMEOUT = env.int('SEARCH_QUERY_TIMEOUT', default=600)
+REMOTE_QUERY_TIMEOUT = env.int('REMOTE_QUERY_TIMEOUT', default=None)
+
+# /metrics (prometheus): requires "Authorization: Bearer <METRICS_TOKEN>" when set. Set
+# PROMETHEUS_MULTIPROC_DIR in the environment of gunicorn and celery to merge their processes
+METRICS_TOKEN = env.str('METRICS_TOKEN', default=None)
+
+# Memory (bytes) the country results of one query may take in a worker before they are
+# spilled to parquet files under MEDIA_ROOT/spill, see search.results.ResultSpool
+SEARCH_QUERY_MEMORY_BUDGET = env.int('SEARCH_QUERY_MEMORY_BUDGET', default=512 * 1024 * 1024)
+
+# Rows per page of the history and remote lists (keyset pagination, newest first)
+HISTORY_PAGE_SIZE = env.int('HISTORY_PAGE_SIZE', default=50)
@@ -1,8 +1,21 @@
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from io import BytesIO
+
 import psycopg2
+import pyarrow as pa
+import pyarrow.csv as pa_csv
 
+from psycopg2 import sql
 from sqlalchemy import create_engine
 from sqlalchemy.pool import QueuePool
 
+logger = logging.getLogger('search')
+
 
 def create_db_psycopg2_connection(host, dbname, user, password):
     return psycopg2.connect(
@@ -15,3 +28,304 @@ def create_db_sqlalchemy_engine(host, dbname, user, password):
         poolclass=QueuePool,
         pool_size=5,
         max_overflow=10)
+
+
+def _address(host, port=None):
+    return f"{host}:{port}" if port else host
+
+
+class EngineRegistry:
+    """
+    Process-wide registry of long-lived pooled engines, one per (host, port, db).
+
+    Engines are created lazily on first use and kept between requests, so
+    repeated fan-outs reuse already established connections instead of paying
+    the TCP + auth handshake for every country on every query.
+    """
+
+    def __init__(self, pool_size=2, max_overflow=2, pool_timeout=30,
+                 pool_recycle=1800, pool_pre_ping=True, idle_timeout=900):
+        self.pool_size = pool_size
+        self.max_overflow = max_overflow
+        self.pool_timeout = pool_timeout
+        self.pool_recycle = pool_recycle
+        self.pool_pre_ping = pool_pre_ping
+        self.idle_timeout = idle_timeout
+
+        self._lock = threading.Lock()
+        self._engines = {}
+        self._pid = os.getpid()
+
+    def _check_fork(self):
+        # Pooled connections must never be shared between a parent and a forked child
+        # (gunicorn/celery prefork workers, multiprocessing): drop inherited engines
+        # without closing the parent's sockets.
+        if self._pid != os.getpid():
+            for entry in self._engines.values():
+                entry['engine'].dispose(close=False)
+            self._engines = {}
+            self._pid = os.getpid()
+
+    def get_engine(self, host, dbname, user, password, port=None):
+        key = (host, port, dbname, user)
+
+        with self._lock:
+            self._check_fork()
+            entry = self._engines.get(key)
+
+            if entry is None:
+                engine = create_engine(
+                    f"postgresql+psycopg2://{user}:{password}@{_address(host, port)}/{dbname}",
+                    poolclass=QueuePool,
+                    pool_size=self.pool_size,
+                    max_overflow=self.max_overflow,
+                    pool_timeout=self.pool_timeout,
+                    pool_recycle=self.pool_recycle,
+                    pool_pre_ping=self.pool_pre_ping)
+                entry = {'engine': engine, 'created_at': time.time(), 'last_used': None, 'hits': 0}
+                self._engines[key] = entry
+                logger.info(f"engine registry: created pool for {dbname}@{_address(host, port)}")
+
+            entry['hits'] += 1
+            entry['last_used'] = time.time()
+
+        self.evict_idle()
+        return entry['engine']
+
+    def warm_up(self, targets, user, password):
+        """Open one pooled connection per (host, port, dbname) in targets."""
+        for host, port, dbname in targets:
+            try:
+                with self.get_engine(host, dbname, user, password, port).connect():
+                    pass
+            except Exception as e:
+                logger.warning(f"engine registry: warm-up failed for {dbname}@{_address(host, port)}: {e}")
+
+    def evict_idle(self):
+        """Dispose engines that have not been used for longer than idle_timeout."""
+        if not self.idle_timeout:
+            return
+
+        now = time.time()
+        with self._lock:
+            idle_keys = [key for key, entry in self._engines.items()
+                         if entry['last_used'] and now - entry['last_used'] > self.idle_timeout
+                         and entry['engine'].pool.checkedout() == 0]
+            for key in idle_keys:
+                self._engines.pop(key)['engine'].dispose()
+                logger.info(f"engine registry: evicted idle pool for {key[2]}@{_address(key[0], key[1])}")
+
+    def dispose_all(self):
+        with self._lock:
+            for entry in self._engines.values():
+                entry['engine'].dispose()
+            self._engines = {}
+
+    def stats(self):
+        with self._lock:
+            return {
+                f"{dbname}@{_address(host, port)}": {
+                    'size': entry['engine'].pool.size(),
+                    'checked_in': entry['engine'].pool.checkedin(),
+                    'checked_out': entry['engine'].pool.checkedout(),
+                    'overflow': entry['engine'].pool.overflow(),
+                    'hits': entry['hits'],
+                    'created_at': entry['created_at'],
+                    'last_used': entry['last_used'],
+                }
+                for (host, port, dbname, user), entry in self._engines.items()
+            }
+
+
+_registries = {}
+_registries_lock = threading.Lock()
+
+
+def get_engine_registry(name='remote'):
+    """
+    Return the process-wide registry configured by settings.DB_ENGINE_REGISTRY[name].
+    """
+    from django.conf import settings
+
+    with _registries_lock:
+        if name not in _registries:
+            options = getattr(settings, 'DB_ENGINE_REGISTRY', {}).get(name, {})
+            _registries[name] = EngineRegistry(**options)
+        return _registries[name]
+
+
+def engine_registries():
+    """The registries created in this process so far, by name (for /metrics)."""
+    with _registries_lock:
+        return dict(_registries)
+
+
+def get_pooled_engine(host, dbname, user, password, port=None, registry='remote'):
+    return get_engine_registry(registry).get_engine(host, dbname, user, password, port)
+
+
+def get_dwh_engine():
+    from django.conf import settings
+
+    return get_pooled_engine(
+        settings.DATABASES['default']['HOST'],
+        settings.DATABASES['default']['NAME'],
+        settings.DATABASES['default']['USER'],
+        settings.DATABASES['default']['PASSWORD'],
+        port=settings.DATABASES['default']['PORT'] or None,
+        registry='dwh')
+
+
+def warm_up_remote_engines():
+    """Pre-open one connection to every country database from search.config."""
+    from django.conf import settings
+    from search.config import connection_info
+
+    targets = [(cluster_conn_info['host'], cluster_conn_info.get('port'), db_name)
+               for cluster_conn_info in connection_info.values()
+               for db_name in cluster_conn_info['dbs']]
+    get_engine_registry('remote').warm_up(targets, settings.REMOTE_DB_USER, settings.REMOTE_DB_PASSWORD)
+
+
+def arrow_type_to_postgres(arrow_type):
+    if pa.types.is_dictionary(arrow_type):
+        return arrow_type_to_postgres(arrow_type.value_type)
+    if pa.types.is_boolean(arrow_type):
+        return 'boolean'
+    if pa.types.is_int8(arrow_type) or pa.types.is_int16(arrow_type) or pa.types.is_uint8(arrow_type):
+        return 'smallint'
+    if pa.types.is_int32(arrow_type) or pa.types.is_uint16(arrow_type):
+        return 'integer'
+    if pa.types.is_int64(arrow_type) or pa.types.is_uint32(arrow_type):
+        return 'bigint'
+    if pa.types.is_uint64(arrow_type) or pa.types.is_decimal(arrow_type):
+        return 'numeric'
+    if pa.types.is_float16(arrow_type) or pa.types.is_float32(arrow_type):
+        return 'real'
+    if pa.types.is_float64(arrow_type):
+        return 'double precision'
+    if pa.types.is_date(arrow_type):
+        return 'date'
+    if pa.types.is_timestamp(arrow_type):
+        return 'timestamp with time zone' if arrow_type.tz else 'timestamp without time zone'
+    if pa.types.is_time(arrow_type):
+        return 'time without time zone'
+    if pa.types.is_duration(arrow_type):
+        return 'interval'
+    if pa.types.is_binary(arrow_type) or pa.types.is_large_binary(arrow_type):
+        return 'bytea'
+    if pa.types.is_nested(arrow_type):
+        return 'jsonb'
+    return 'text'
+
+
+def csv_compatible(table):
+    # the csv writer can't render nested values (postgres arrays, json objects): send them as json text,
+    # bytea and intervals go as their postgres text input format
+    for i, field in enumerate(table.schema):
+        if pa.types.is_nested(field.type):
+            values = [None if value is None else json.dumps(value, default=str) for value in table.column(i).to_pylist()]
+            table = table.set_column(i, field.name, pa.array(values, pa.string()))
+        elif pa.types.is_binary(field.type) or pa.types.is_large_binary(field.type):
+            values = [None if value is None else '\\x' + value.hex() for value in table.column(i).to_pylist()]
+            table = table.set_column(i, field.name, pa.array(values, pa.string()))
+        elif pa.types.is_duration(field.type):
+            values = [None if value is None else f"{value.total_seconds()} seconds" for value in table.column(i).to_pylist()]
+            table = table.set_column(i, field.name, pa.array(values, pa.string()))
+    return table
+
+
+def _copy_batches(cursor, batches, schema, table_name, logged=True, create=True):
+    """
+    Create schema.table_name from the first batch (unless create=False, then it must
+    already exist) and COPY all batches into it.
+    """
+    rows = 0
+    created = False
+
+    for batch in batches:
+        table = batch if isinstance(batch, pa.Table) else pa.Table.from_batches([batch])
+
+        if not created:
+            if create:
+                columns = sql.SQL(', ').join(
+                    sql.SQL('{} {}').format(sql.Identifier(field.name), sql.SQL(arrow_type_to_postgres(field.type)))
+                    for field in table.schema)
+                cursor.execute(sql.SQL('CREATE {}TABLE {}.{} ({})').format(
+                    sql.SQL('' if logged else 'UNLOGGED '), sql.Identifier(schema), sql.Identifier(table_name), columns))
+            copy_statement = sql.SQL('COPY {}.{} ({}) FROM STDIN WITH (FORMAT csv)').format(
+                sql.Identifier(schema), sql.Identifier(table_name),
+                sql.SQL(', ').join(sql.Identifier(name) for name in table.schema.names)).as_string(cursor)
+            created = True
+
+        if table.num_rows == 0:
+            continue
+
+        # one batch worth of csv at a time, the full result is never materialized
+        buffer = BytesIO()
+        pa_csv.write_csv(csv_compatible(table), buffer, pa_csv.WriteOptions(include_header=False))
+        buffer.seek(0)
+        cursor.copy_expert(copy_statement, buffer)
+        rows += table.num_rows
+
+    return created, rows
+
+
+def copy_to_db(batches, table_name, schema='catopus', engine=None, staging=None, append=False):
+    """
+    Bulk load Arrow record batches/tables into a new table with COPY ... FROM STDIN.
+
+    The table is created from the schema of the first batch. Without staging the
+    CREATE and all COPYs run in one transaction, so the table only shows up complete.
+    With staging=True the data goes into an UNLOGGED staging table first (no WAL while
+    loading), which is switched to LOGGED and renamed to table_name in one transaction.
+
+    With append=True the batches are added to the existing table_name in one transaction
+    (staging does not apply). staging defaults to settings.DWH_BULK_LOAD_STAGING.
+    Returns the number of rows loaded.
+    """
+    from django.conf import settings
+
+    if append:
+        staging = False
+    elif staging is None:
+        staging = getattr(settings, 'DWH_BULK_LOAD_STAGING', False)
+
+    connection = (engine or get_dwh_engine()).raw_connection()
+    try:
+        with connection.cursor() as cursor:
+            if not staging:
+                created, rows = _copy_batches(cursor, batches, schema, table_name, create=not append)
+            else:
+                staging_name = f"{table_name}__staging_{uuid.uuid4().hex[:8]}"
+                created, rows = _copy_batches(cursor, batches, schema, staging_name, logged=False)
+                connection.commit()
+
+                if created:
+                    cursor.execute(sql.SQL('ALTER TABLE {}.{} SET LOGGED').format(
+                        sql.Identifier(schema), sql.Identifier(staging_name)))
+                    cursor.execute(sql.SQL('ALTER TABLE {}.{} RENAME TO {}').format(
+                        sql.Identifier(schema), sql.Identifier(staging_name), sql.Identifier(table_name)))
+
+            if not created:
+                raise ValueError(f"No data to create {schema}.{table_name} from")
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        if staging:
+            _drop_table_quietly(connection, schema, staging_name)
+        raise
+    finally:
+        connection.close()
+
+    logger.info(f"copy_to_db: loaded {rows} rows into {schema}.{table_name}")
+    return rows
+
+
+def _drop_table_quietly(connection, schema, table_name):
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(sql.SQL('DROP TABLE IF EXISTS {}.{}').format(sql.Identifier(schema), sql.Identifier(table_name)))
+        connection.commit()
+    except psycopg2.Error as e:
+        logger.warning(f"copy_to_db: could not drop {schema}.{table_name}: {e}")
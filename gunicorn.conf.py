@@ -0,0 +1,22 @@
+# gunicorn picks this file up automatically from the working directory
+import threading
+
+
+def post_worker_init(worker):
+    from django.conf import settings
+
+    if settings.REMOTE_DB_WARMUP:
+        from catopus.utils.database import warm_up_remote_engines
+
+        # don't block the worker from accepting requests while ~69 dbs are connecting
+        threading.Thread(target=warm_up_remote_engines, daemon=True).start()
+
+
+def child_exit(server, worker):
+    import os
+
+    # drop the live gauges (in-flight queries) of a dead worker from /metrics
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(worker.pid)
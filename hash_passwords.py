@@ -1,19 +1,17 @@
 import os
+import sys
+
 import django
-from django.contrib.auth.hashers import make_password
+from django.core.management import call_command
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'catopus.settings')
 django.setup()
 
-from account.models import LoginCreds
 
 def hash_existing_passwords():
-    all_users = LoginCreds.objects.all()
+    # kept for existing callers, see account/management/commands/hash_passwords.py
+    call_command('hash_passwords', *sys.argv[1:])
 
-    for user in all_users:
-        hashed_password = make_password(user.password)
-        user.hashed_password = hashed_password
-        user.save()
 
 if __name__ == '__main__':
     hash_existing_passwords()
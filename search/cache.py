@@ -0,0 +1,60 @@
+import hashlib
+import logging
+from typing import Dict, List, Optional, Tuple
+
+import sqlparse
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .models import SearchResult
+
+logger = logging.getLogger('search')
+
+
+def normalize_sql(code: str) -> str:
+    """Drop comments, lowercase keywords and collapse whitespace outside of literals."""
+    formatted = sqlparse.format(code, strip_comments=True, keyword_case='lower')
+
+    parts = []
+    for statement in sqlparse.parse(formatted):
+        for token in statement.flatten():
+            if token.is_whitespace:
+                if parts and parts[-1] != ' ':
+                    parts.append(' ')
+            else:
+                parts.append(token.value)
+    return ''.join(parts).strip().rstrip(';').strip()
+
+
+def query_fingerprint(code: str, countries: List[str]) -> str:
+    key = normalize_sql(code) + '|' + ','.join(sorted(set(countries)))
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def _cache():
+    return caches[settings.SEARCH_RESULT_CACHE['alias']]
+
+
+def get_cached_result(code: str, countries: List[str]) -> Optional[Tuple[SearchResult, Dict[str, List[str]]]]:
+    """
+    SearchResult of an earlier run of the same query over the same countries, if still
+    cached, with the countries missing from it ({'failed': [...], 'timed_out': [...]}).
+    """
+    entry = _cache().get(f"search_result:{query_fingerprint(code, countries)}")
+    if entry is None:
+        return None
+
+    search_result = SearchResult.objects.filter(identifier=entry['identifier']).first()
+    if search_result is None or not search_result.search_results_file.storage.exists(search_result.search_results_file.name):
+        logger.info(f"result cache: stale entry for {entry['identifier']}")
+        return None
+    return search_result, {'failed': entry['failed'], 'timed_out': entry['timed_out']}
+
+
+def cache_result(code: str, countries: List[str], identifier: str, ttl: int = None,
+                 failed: List[str] = (), timed_out: List[str] = ()):
+    ttl = settings.SEARCH_RESULT_CACHE['ttl'] if ttl is None else ttl
+    if ttl > 0:
+        entry = {'identifier': identifier, 'failed': sorted(failed), 'timed_out': sorted(timed_out)}
+        _cache().set(f"search_result:{query_fingerprint(code, countries)}", entry, timeout=ttl)
@@ -0,0 +1,143 @@
+import datetime
+import os
+import tempfile
+from decimal import Decimal
+from io import RawIOBase
+from typing import Iterator
+
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+
+from catopus.utils.database import csv_compatible
+
+from .results import iter_row_groups, open_result_file
+
+# format -> (content type, file extension)
+EXPORT_FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'arrow': ('application/vnd.apache.arrow.stream', 'arrows'),
+    'xlsx': ('application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', 'xlsx'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+}
+
+# rows + header row of an excel sheet
+XLSX_MAX_ROWS = 1_048_575
+
+CHUNK_SIZE = 1 << 20
+
+
+class _ChunkSink(RawIOBase):
+    """Write-only file for the arrow writers: keeps what was written until it is drained."""
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _csv_chunks(parquet) -> Iterator[bytes]:
+    # arrays, json and bytea are written the way they would be copied into postgres
+    sink = _ChunkSink()
+    writer = pa_csv.CSVWriter(sink, csv_compatible(parquet.schema_arrow.empty_table()).schema)
+    for table in iter_row_groups(parquet):
+        writer.write_table(csv_compatible(table))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+def _arrow_chunks(parquet) -> Iterator[bytes]:
+    sink = _ChunkSink()
+    with pa.ipc.new_stream(sink, parquet.schema_arrow) as writer:
+        for table in iter_row_groups(parquet):
+            writer.write_table(table)
+            yield sink.drain()
+    yield sink.drain()
+
+
+def _xlsx_value(value):
+    if isinstance(value, (str, int, float, bool, Decimal, datetime.date, datetime.time, datetime.timedelta)) or value is None:
+        return value
+    if isinstance(value, (bytes, bytearray)):
+        return value.hex()
+    return str(value)
+
+
+def _xlsx_chunks(parquet) -> Iterator[bytes]:
+    # a workbook is a zip written on close: rows go to a temp file (constant_memory keeps
+    # only the current row in memory), which is streamed once complete
+    import xlsxwriter
+
+    handle, path = tempfile.mkstemp(suffix='.xlsx')
+    os.close(handle)
+    try:
+        workbook = xlsxwriter.Workbook(path, {'constant_memory': True, 'remove_timezone': True,
+                                              'default_date_format': 'yyyy-mm-dd hh:mm:ss'})
+        sheet = workbook.add_worksheet('result')
+        sheet.write_row(0, 0, parquet.schema_arrow.names)
+        row_number = 1
+        for table in iter_row_groups(parquet):
+            columns = [column.to_pylist() for column in table.columns]
+            for row in zip(*columns):
+                sheet.write_row(row_number, 0, [_xlsx_value(value) for value in row])
+                row_number += 1
+        workbook.close()
+
+        with open(path, 'rb') as xlsx_file:
+            while True:
+                chunk = xlsx_file.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+    finally:
+        os.remove(path)
+
+
+def _parquet_chunks(result_file) -> Iterator[bytes]:
+    result_file.open('rb')
+    try:
+        while True:
+            chunk = result_file.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        result_file.close()
+
+
+def export_result(search_result, export_format: str) -> Iterator[bytes]:
+    """
+    The stored result of a SearchResult in the given format, as chunks for a streaming
+    response. Converted formats are written one row group at a time, parquet is passed through.
+    """
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"Unsupported export format: {export_format}")
+
+    if export_format == 'parquet':
+        yield from _parquet_chunks(search_result.search_results_file)
+        return
+
+    with open_result_file(search_result) as parquet:
+        if export_format == 'csv':
+            yield from _csv_chunks(parquet)
+        elif export_format == 'arrow':
+            yield from _arrow_chunks(parquet)
+        else:
+            yield from _xlsx_chunks(parquet)
@@ -0,0 +1,113 @@
+import os
+
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+from prometheus_client import REGISTRY, multiprocess
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+# gunicorn and celery run several processes: with PROMETHEUS_MULTIPROC_DIR set, every
+# process writes its samples there and the /metrics view merges them
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+FAST_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (0, 10, 100, 1_000, 10_000, 100_000, 1_000_000, 10_000_000, 100_000_000)
+
+FANOUT_SECONDS = Histogram(
+    'catopus_search_fanout_seconds', 'Wall time of a query over all selected countries',
+    ['mode'], buckets=LATENCY_BUCKETS)
+COUNTRY_QUERIES = Counter(
+    'catopus_search_country_queries_total', 'Country query executions by final status',
+    ['cluster', 'status'])
+COUNTRY_QUERY_SECONDS = Histogram(
+    'catopus_search_country_query_seconds', 'Wall time of a single country query',
+    ['cluster'], buckets=LATENCY_BUCKETS)
+CLUSTER_IN_FLIGHT = Gauge(
+    'catopus_search_cluster_in_flight', 'Country queries currently running per cluster',
+    ['cluster'], multiprocess_mode='livesum')
+PARQUET_WRITE_SECONDS = Histogram(
+    'catopus_search_parquet_write_seconds', 'Time to serialize a query result to parquet',
+    buckets=FAST_BUCKETS)
+HTML_RENDER_SECONDS = Histogram(
+    'catopus_search_html_render_seconds', 'Time to render the first result page with to_html',
+    buckets=FAST_BUCKETS)
+DWH_LOAD_SECONDS = Histogram(
+    'catopus_search_dwh_load_seconds', 'Time to write a result into the dwh (COPY)',
+    ['source'], buckets=LATENCY_BUCKETS)
+REMOTE_JOB_SECONDS = Histogram(
+    'catopus_search_remote_job_seconds', 'Duration of remote (celery) runs by final status',
+    ['status'], buckets=LATENCY_BUCKETS)
+RESULT_ROWS = Histogram(
+    'catopus_search_result_rows', 'Rows of stored query results',
+    buckets=SIZE_BUCKETS)
+RESULT_BYTES = Histogram(
+    'catopus_search_result_bytes', 'Size of stored parquet query results',
+    buckets=SIZE_BUCKETS)
+
+
+def record_country_query(record):
+    """Count one finished country execution (a search.telemetry record)."""
+    COUNTRY_QUERIES.labels(record['cluster'], record['status']).inc()
+    COUNTRY_QUERY_SECONDS.labels(record['cluster']).observe(record['total_seconds'])
+
+
+class PoolStatsCollector:
+    """
+    Connection pools of the engine registries and the cluster limits of the scheduler,
+    read when /metrics is scraped. Both live in each process, so with several gunicorn
+    workers every series is labelled with the pid of the worker that answered the scrape.
+    """
+
+    def describe(self):
+        # nothing to check at registration, collect() imports the modules that import this one
+        return []
+
+    def collect(self):
+        from catopus.utils.database import engine_registries
+        from .scheduler import cluster_scheduler
+
+        pid = str(os.getpid())
+        connections = GaugeMetricFamily(
+            'catopus_db_pool_connections', 'Connections of a pooled engine by state',
+            labels=['registry', 'database', 'state', 'pid'])
+        pool_size = GaugeMetricFamily(
+            'catopus_db_pool_size', 'Configured size of a pooled engine',
+            labels=['registry', 'database', 'pid'])
+        checkouts = CounterMetricFamily(
+            'catopus_db_pool_engine_requests', 'Times an engine was handed out by its registry',
+            labels=['registry', 'database', 'pid'])
+        for name, registry in engine_registries().items():
+            for database, stats in registry.stats().items():
+                for state in ('checked_in', 'checked_out', 'overflow'):
+                    connections.add_metric([name, database, state, pid], stats[state])
+                pool_size.add_metric([name, database, pid], stats['size'])
+                checkouts.add_metric([name, database, pid], stats['hits'])
+
+        limit = GaugeMetricFamily(
+            'catopus_search_cluster_limit', 'Current AIMD concurrency limit of a cluster',
+            labels=['cluster', 'pid'])
+        latency = GaugeMetricFamily(
+            'catopus_search_cluster_latency_seconds', 'Moving average latency of a cluster\'s queries',
+            labels=['cluster', 'pid'])
+        for cluster, stats in cluster_scheduler.stats().items():
+            limit.add_metric([cluster, pid], stats['limit'])
+            if stats['ewma_latency'] is not None:
+                latency.add_metric([cluster, pid], stats['ewma_latency'])
+
+        return [connections, pool_size, checkouts, limit, latency]
+
+
+POOL_STATS = PoolStatsCollector()
+REGISTRY.register(POOL_STATS)
+
+
+def metrics_registry():
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        registry.register(POOL_STATS)
+        return registry
+    return REGISTRY
+
+
+def render_metrics():
+    """Body and content type of a /metrics response."""
+    return generate_latest(metrics_registry()), CONTENT_TYPE_LATEST
@@ -0,0 +1,45 @@
+# Generated by Django 4.1.13 on 2026-10-18 07:37
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("search", "0009_rename_query_remotelogs_sql_query_and_more"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="remotelogs",
+            name="task_id",
+            field=models.CharField(max_length=255, null=True),
+        ),
+        migrations.CreateModel(
+            name="RemoteCountryProgress",
+            fields=[
+                ("id", models.AutoField(primary_key=True, serialize=False)),
+                ("country", models.CharField(max_length=10)),
+                ("status", models.CharField(default="pending", max_length=10)),
+                ("rows", models.BigIntegerField(null=True)),
+                ("bytes", models.BigIntegerField(null=True)),
+                ("seconds", models.FloatField(null=True)),
+                ("message", models.TextField(null=True)),
+                ("updated_on", models.DateTimeField(null=True)),
+                (
+                    "remote_log",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="country_progress",
+                        to="search.remotelogs",
+                    ),
+                ),
+            ],
+            options={
+                "db_table": '"dwh_system"."cat_remote_country_progress"',
+                "managed": True,
+                "unique_together": {("remote_log", "country")},
+            },
+        ),
+    ]
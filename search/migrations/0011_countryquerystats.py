@@ -0,0 +1,53 @@
+# Generated by Django 4.1.13 on 2026-10-18 07:43
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ("search", "0010_remotelogs_task_id_remotecountryprogress"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="CountryQueryStats",
+            fields=[
+                ("id", models.AutoField(primary_key=True, serialize=False)),
+                ("identifier", models.CharField(max_length=255, null=True)),
+                ("source", models.CharField(max_length=10)),
+                ("country", models.CharField(max_length=10)),
+                ("cluster", models.CharField(max_length=10)),
+                ("status", models.CharField(max_length=10)),
+                ("connect_seconds", models.FloatField(null=True)),
+                ("execute_seconds", models.FloatField(null=True)),
+                ("fetch_seconds", models.FloatField(null=True)),
+                ("total_seconds", models.FloatField()),
+                ("rows", models.BigIntegerField(default=0)),
+                ("bytes", models.BigIntegerField(default=0)),
+                ("error_class", models.CharField(max_length=255, null=True)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                (
+                    "user",
+                    models.ForeignKey(
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+            options={
+                "db_table": '"dwh_system"."cat_country_query_stats"',
+                "managed": True,
+            },
+        ),
+        migrations.AddIndex(
+            model_name="countryquerystats",
+            index=models.Index(
+                fields=["created_at", "country"], name="cat_country_created_d61bbd_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 4.1.13 on 2026-10-18 07:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("search", "0011_countryquerystats"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="remotelogs",
+            index=models.Index(
+                fields=["user", "-updated_on", "-id"], name="remote_logs_user_updated"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="searchresult",
+            index=models.Index(
+                fields=["user", "-created_at", "-id"], name="search_result_user_created"
+            ),
+        ),
+    ]
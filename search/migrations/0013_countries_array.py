@@ -0,0 +1,102 @@
+import ast
+
+import django.contrib.postgres.fields
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+
+MODELS = ("searchresult", "remotelogs", "savedscripts")
+
+
+def _parse_countries(text):
+    # str(list) written by the views, e.g. "['de', 'fr']"
+    if not text:
+        return []
+    try:
+        countries = ast.literal_eval(text)
+    except (ValueError, SyntaxError):
+        countries = text.strip("[]").split(",")
+    if isinstance(countries, str):
+        countries = [countries]
+    return [str(country).strip().strip("'\"") for country in countries if str(country).strip()]
+
+
+def countries_to_array(apps, schema_editor):
+    for model_name in MODELS:
+        model = apps.get_model("search", model_name)
+        batch = []
+        for row in model.objects.only("id", "countries").iterator(chunk_size=2000):
+            row.countries_array = _parse_countries(row.countries)
+            batch.append(row)
+            if len(batch) == 2000:
+                model.objects.bulk_update(batch, ["countries_array"])
+                batch = []
+        model.objects.bulk_update(batch, ["countries_array"])
+
+
+def countries_to_text(apps, schema_editor):
+    for model_name in MODELS:
+        model = apps.get_model("search", model_name)
+        batch = []
+        for row in model.objects.only("id", "countries_array").iterator(chunk_size=2000):
+            row.countries = str(row.countries_array)
+            batch.append(row)
+            if len(batch) == 2000:
+                model.objects.bulk_update(batch, ["countries"])
+                batch = []
+        model.objects.bulk_update(batch, ["countries"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("search", "0012_history_keyset_indexes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name=model_name,
+            name="countries_array",
+            field=django.contrib.postgres.fields.ArrayField(
+                base_field=models.CharField(max_length=10), default=list, size=None
+            ),
+        )
+        for model_name in MODELS
+    ] + [
+        # nullable while both columns exist, so that the migration can be reversed
+        migrations.AlterField(
+            model_name=model_name,
+            name="countries",
+            field=models.CharField(max_length=255, null=True),
+        )
+        for model_name in ("remotelogs", "savedscripts")
+    ] + [
+        migrations.RunPython(countries_to_array, countries_to_text),
+    ] + [
+        operation
+        for model_name in MODELS
+        for operation in (
+            migrations.RemoveField(model_name=model_name, name="countries"),
+            migrations.RenameField(
+                model_name=model_name, old_name="countries_array", new_name="countries"
+            ),
+        )
+    ] + [
+        migrations.AddIndex(
+            model_name="searchresult",
+            index=django.contrib.postgres.indexes.GinIndex(
+                fields=["countries"], name="search_result_countries"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="remotelogs",
+            index=django.contrib.postgres.indexes.GinIndex(
+                fields=["countries"], name="remote_logs_countries"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="savedscripts",
+            index=django.contrib.postgres.indexes.GinIndex(
+                fields=["countries"], name="saved_scripts_countries"
+            ),
+        ),
+    ]
@@ -1,4 +1,6 @@
 from django.db import models
+from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.indexes import GinIndex
 from account.models import LoginCreds
 
 
@@ -9,11 +11,14 @@ class SearchResult(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     sql_query = models.TextField(null=True)
     countries_list = models.CharField(max_length=50, null=True)
-    countries = models.CharField(max_length=8192, null=True)
+    countries = ArrayField(models.CharField(max_length=10), default=list)
 
     class Meta:
         managed = True
         db_table = '"dwh_system"."cat_search_result"'
+        # keyset pages of the history view
+        indexes = [models.Index(fields=['user', '-created_at', '-id'], name='search_result_user_created'),
+                   GinIndex(fields=['countries'], name='search_result_countries')]
 
 
 class RemoteLogs(models.Model):
@@ -25,14 +30,35 @@ class RemoteLogs(models.Model):
     table_name_created = models.CharField(max_length=50, null=True)
     log_field = models.TextField(null=True)
     countries_list = models.CharField(max_length=50, null=True)
-    countries = models.CharField(max_length=255)
+    countries = ArrayField(models.CharField(max_length=10), default=list)
     run_on = models.DateTimeField(auto_now=True)
     updated_on = models.DateTimeField(null=True)
+    task_id = models.CharField(max_length=255, null=True)
 
 
     class Meta:
         managed = True
         db_table = '"dwh_system"."cat_remote_logs"'
+        # keyset pages of the remote view
+        indexes = [models.Index(fields=['user', '-updated_on', '-id'], name='remote_logs_user_updated'),
+                   GinIndex(fields=['countries'], name='remote_logs_countries')]
+
+
+class RemoteCountryProgress(models.Model):
+    id = models.AutoField(primary_key=True)
+    remote_log = models.ForeignKey(RemoteLogs, on_delete=models.CASCADE, related_name='country_progress')
+    country = models.CharField(max_length=10)
+    status = models.CharField(max_length=10, default='pending')
+    rows = models.BigIntegerField(null=True)
+    bytes = models.BigIntegerField(null=True)
+    seconds = models.FloatField(null=True)
+    message = models.TextField(null=True)
+    updated_on = models.DateTimeField(null=True)
+
+    class Meta:
+        managed = True
+        db_table = '"dwh_system"."cat_remote_country_progress"'
+        unique_together = [('remote_log', 'country')]
 
 
 class SavedScripts(models.Model):
@@ -40,11 +66,34 @@ class SavedScripts(models.Model):
     user = models.ForeignKey(LoginCreds, on_delete=models.CASCADE)
     sql_query = models.TextField()
     countries_list = models.CharField(max_length=50, null=True)
-    countries = models.CharField(max_length=255)
+    countries = ArrayField(models.CharField(max_length=10), default=list)
     saved_on = models.DateTimeField(auto_now_add=True)
     updated_on = models.DateTimeField(null=True)
     deleted_on = models.DateTimeField(null=True)
 
     class Meta:
         managed = True
-        db_table = '"dwh_system"."cat2_saved_scripts"'
\ No newline at end of file
+        db_table = '"dwh_system"."cat2_saved_scripts"'
+        indexes = [GinIndex(fields=['countries'], name='saved_scripts_countries')]
+
+class CountryQueryStats(models.Model):
+    id = models.AutoField(primary_key=True)
+    user = models.ForeignKey(LoginCreds, on_delete=models.SET_NULL, null=True)
+    identifier = models.CharField(max_length=255, null=True)  # SearchResult.identifier or RemoteLogs.id
+    source = models.CharField(max_length=10)  # query / remote
+    country = models.CharField(max_length=10)
+    cluster = models.CharField(max_length=10)
+    status = models.CharField(max_length=10)
+    connect_seconds = models.FloatField(null=True)
+    execute_seconds = models.FloatField(null=True)
+    fetch_seconds = models.FloatField(null=True)
+    total_seconds = models.FloatField()
+    rows = models.BigIntegerField(default=0)
+    bytes = models.BigIntegerField(default=0)
+    error_class = models.CharField(max_length=255, null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        managed = True
+        db_table = '"dwh_system"."cat_country_query_stats"'
+        indexes = [models.Index(fields=['created_at', 'country'])]
@@ -1,23 +1,35 @@
+import json
 import logging
 import os
-import pandas as pd
+import queue
+import threading
+import time
+import uuid
+import numpy as np
+import pyarrow as pa
+import sqlparse
 
 from multiprocessing import Process
 from multiprocessing import Queue, Manager
 
 from django.utils import timezone
 
+import psycopg2
 from psycopg2 import errors as psycopg2_errors
-from sqlalchemy import text
+from sqlalchemy import exc as sqlalchemy_exc
 from dotenv import load_dotenv
-from typing import Dict, List
+from typing import Dict, Iterator, List, Tuple
 from django.conf import settings
 
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor
 
 # custom modules
 from search.config import connection_info, map_country_code_to_id as code_to_id
-from catopus.utils.database import create_db_sqlalchemy_engine
+from catopus.utils.database import copy_to_db, get_pooled_engine
+from search.results import ResultSpool
+from search.metrics import DWH_LOAD_SECONDS, FANOUT_SECONDS, record_country_query
+from search.scheduler import cluster_scheduler
+from search.telemetry import current_country_stats, new_country_record
 
 logger = logging.getLogger('search')
 
@@ -25,86 +37,393 @@ load_dotenv()
 
 
 
-#  Read sql query from input field
-def exec_sql_multiproc(info: Dict[str, str]):
+# postgres json/jsonb oids, psycopg2 parses them into python dicts/lists
+JSON_TYPE_OIDS = (114, 3802)
+
+
+def _to_arrow_column(values: list, type_code: int) -> pa.Array:
+    if type_code in JSON_TYPE_OIDS:
+        values = [None if value is None else json.dumps(value) for value in values]
     try:
+        array = pa.array(values)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, OverflowError):
+        # python types arrow can't infer a single type for: keep their text representation
+        return pa.array([None if value is None else str(value) for value in values], pa.string())
+
+    if pa.types.is_decimal(array.type):
+        # same as coerce_float of pd.read_sql_query, also keeps one type for all batches
+        array = array.cast(pa.float64())
+    return array
+
+
+# one shared buffer of zero dictionary indices, sliced for every batch of every country
+_zero_indices = pa.py_buffer(np.zeros(0, np.int8))
+_zero_indices_lock = threading.Lock()
+
+
+def _constant_indices(length: int) -> pa.Array:
+    global _zero_indices
+
+    with _zero_indices_lock:
+        if _zero_indices.size < length:
+            _zero_indices = pa.py_buffer(np.zeros(max(length, 2 * _zero_indices.size), np.int8))
+        zero_indices = _zero_indices
+    return pa.Array.from_buffers(pa.int8(), length, [None, zero_indices])
+
+
+def country_tag_arrays(db_name: str, length: int) -> Tuple[pa.DictionaryArray, pa.DictionaryArray]:
+    """
+    _country_id and _country_code columns for `length` rows of db_name.
+
+    Both are single-value dictionary arrays over the shared zero indices buffer,
+    so tagging a batch allocates nothing proportional to its size.
+    """
+    indices = _constant_indices(length)
+    return (pa.DictionaryArray.from_arrays(indices, pa.array([code_to_id[db_name]], pa.int64())),
+            pa.DictionaryArray.from_arrays(indices, pa.array([db_name], pa.string())))
+
+
+def rows_to_record_batch(rows: list, description, db_name: str) -> pa.RecordBatch:
+    """
+    Build a record batch of fetched rows, prefixed with the _country_id/_country_code columns.
+    Without rows the columns are still there (of null type), so an empty result keeps its header.
+    """
+    columns = list(zip(*rows)) or [() for _ in description]
+    arrays = [_to_arrow_column(list(values), column.type_code) for values, column in zip(columns, description)]
+
+    return pa.RecordBatch.from_arrays(
+        [*country_tag_arrays(db_name, len(rows)), *arrays],
+        names=['_country_id', '_country_code', *[column.name for column in description]])
+
+
+def concat_batches(batches: List[pa.RecordBatch]) -> pa.Table:
+    # zero-copy: the table just references the batches as chunks;
+    # permissive promotion handles e.g. an all-null batch followed by typed ones
+    return pa.concat_tables([pa.Table.from_batches([batch]) for batch in batches], promote_options='permissive')
+
+
+class QueryDeadlineExceeded(Exception):
+    pass
+
+
+class QueryCancellation:
+    """
+    Connections of the countries currently running for one query, so that all of their
+    in-flight statements can be cancelled at once (user abort or deadline).
+    """
+
+    def __init__(self):
+        self.cancelled = False
+        self._connections = {}
+        self._lock = threading.Lock()
+
+    def register(self, db_name: str, connection):
+        with self._lock:
+            if self.cancelled:
+                raise QueryDeadlineExceeded(f"{db_name}: query cancelled before it started")
+            self._connections[db_name] = connection
+
+    def unregister(self, db_name: str):
+        with self._lock:
+            self._connections.pop(db_name, None)
+
+    def cancel_all(self):
+        # cancel under the lock: unregister() waits for it, so a connection can't be back
+        # in the pool and running someone else's query when its cancel request arrives
+        with self._lock:
+            self.cancelled = True
+            for db_name, connection in self._connections.items():
+                try:
+                    # same as pg_cancel_backend() on the country's backend
+                    connection.dbapi_connection.cancel()
+                    logger.info(f"cancelled running query on {db_name}")
+                except psycopg2.Error as e:
+                    logger.warning(f"could not cancel query on {db_name}: {e}")
+
+
+def _declarable(code: str) -> bool:
+    # DECLARE ... CURSOR FOR only takes a single SELECT, VALUES or TABLE command (WITH too, if it ends in a SELECT)
+    statements = [statement for statement in sqlparse.parse(code) if statement.token_first(skip_cm=True)]
+    if len(statements) != 1:
+        return False
+    first_word = statements[0].token_first(skip_cm=True).value.lstrip('(').split(None, 1)[0].upper()
+    return statements[0].get_type() == 'SELECT' or first_word in ('SELECT', 'VALUES', 'TABLE')
+
+
+def _remaining_ms(deadline: float) -> int:
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise QueryDeadlineExceeded("query deadline passed")
+    return max(1, int(remaining * 1000))
+
+
+#  Read sql query from input field, batch by batch through a server-side cursor
+def exec_sql_multiproc(info: Dict[str, str], batch_size: int, deadline: float = None,
+                       cancellation: QueryCancellation = None, record: Dict = None) -> Iterator[pa.RecordBatch]:
+    """
+    deadline is a time.monotonic() value: every statement gets the remaining time as
+    statement_timeout and QueryDeadlineExceeded is raised once it has passed.
+    With a cancellation, the connection can be cancelled from another thread.
+    A record (see search.telemetry.new_country_record) gets the connect/execute/fetch
+    times, rows and bytes.
+    """
+    record = record if record is not None else new_country_record(info)
+
+    # wait for a free slot on the country's cluster, see search/scheduler.py
+    with cluster_scheduler.slot(info['cluster']) as slot:
         get_query = info
 
-        df = pd.read_sql_query(sql=text(get_query['code']),
-                               con=create_db_sqlalchemy_engine(get_query['host'],
-                                                                get_query['db_name'],
-                                                                settings.REMOTE_DB_USER,
-                                                                settings.REMOTE_DB_PASSWORD))
+        engine = get_pooled_engine(get_query['host'],
+                                   get_query['db_name'],
+                                   settings.REMOTE_DB_USER,
+                                   settings.REMOTE_DB_PASSWORD,
+                                   get_query.get('port'))
+        start = time.monotonic()
+        connection = None
+        try:
+            connection = engine.raw_connection()
+            record['connect_seconds'] = time.monotonic() - start
+            if cancellation is not None:
+                cancellation.register(get_query['db_name'], connection)
+            if deadline is not None:
+                with connection.cursor() as settings_cursor:
+                    # LOCAL: reset when the connection goes back to the pool (rollback)
+                    settings_cursor.execute("SET LOCAL statement_timeout = %s", (_remaining_ms(deadline),))
+
+            execute_start = time.monotonic()
+            named = _declarable(get_query['code'])
+            if named:
+                # a named cursor keeps the result on the server, only batch_size rows are on the client at a time
+                cursor = connection.cursor(name=f"catopus_{uuid.uuid4().hex}")
+                cursor.itersize = batch_size
+            else:
+                # SHOW, EXPLAIN, DML ... RETURNING or several statements can't be declared as a cursor
+                cursor = connection.cursor()
+            cursor.execute(get_query['code'])
+
+            yielded = False
+            while True:
+                if deadline is not None:
+                    _remaining_ms(deadline)
+                fetch_start = time.monotonic()
+                # a named cursor only has a description after its first fetch, a client cursor has none without rows
+                rows = cursor.fetchmany(batch_size) if named or cursor.description else []
+                if slot.latency is None:
+                    # the first fetch runs the query, later ones depend on how fast we consume
+                    slot.observe(time.monotonic() - start)
+                    record['execute_seconds'] = time.monotonic() - execute_start
+                    record['fetch_seconds'] = 0.0
+                else:
+                    record['fetch_seconds'] += time.monotonic() - fetch_start
+                if not rows:
+                    if not yielded and cursor.description:
+                        # no rows: an empty batch still carries the columns of the result
+                        yield rows_to_record_batch([], cursor.description, get_query['db_name'])
+                    break
+                batch = rows_to_record_batch(rows, cursor.description, get_query['db_name'])
+                record['rows'] += batch.num_rows
+                record['bytes'] += batch.nbytes
+                yielded = True
+                yield batch
+
+            cursor.close()
+        except psycopg2_errors.QueryCanceled:  # statement_timeout or cancel_all, not the cluster's fault
+            raise
+        except psycopg2.OperationalError:  # connection/timeout errors: the cluster is struggling
+            slot.mark_overloaded()
+            raise
+        except sqlalchemy_exc.DBAPIError as e:  # raw_connection() wraps the psycopg2 connect error
+            if isinstance(e.orig, psycopg2.OperationalError):
+                slot.mark_overloaded()
+            raise
+        except sqlalchemy_exc.TimeoutError:  # no free connection in the engine's pool
+            slot.mark_overloaded()
+            raise
+        finally:
+            if cancellation is not None:
+                cancellation.unregister(get_query['db_name'])
+            if connection is not None:
+                connection.close()  # rolls back and returns the connection to the pool
+
+
+def _put(events: queue.Queue, event: Tuple, stop: threading.Event):
+    # block while the consumer is behind, but give up once it has gone away
+    while not stop.is_set():
+        try:
+            events.put(event, timeout=0.1)
+            return
+        except queue.Full:
+            continue
 
-        columns = list(df.columns)
-        copy_df = df.copy()
-        copy_df['_country_code'] = get_query['db_name']
-        copy_df['_country_id'] = code_to_id[get_query['db_name']]
-        final_df = copy_df[['_country_id', '_country_code', *columns]]
 
-        return final_df
+def _finish_record(record: Dict, start: float, status: str, error: Exception = None, country_stats: List = None):
+    record['status'] = status
+    record['total_seconds'] = time.monotonic() - start
+    if error is not None:
+        record['error_class'] = type(error).__name__
+    record_country_query(record)
+    if country_stats is not None:
+        country_stats.append(record)
+
+
+def _stream_country(info: Dict[str, str], batch_size: int, events: queue.Queue, stop: threading.Event,
+                    deadline: float = None, cancellation: QueryCancellation = None, country_stats: List = None):
+    db_name = info['db_name']
+    stats = {'rows': 0, 'batches': 0}
+    record = new_country_record(info)
+    start = time.monotonic()
+
+    try:
+        batches = exec_sql_multiproc(info, batch_size, deadline, cancellation, record)
+        for batch in batches:
+            stats['rows'] += batch.num_rows
+            stats['batches'] += 1
+            _put(events, ('batch', db_name, batch), stop)
+            if stop.is_set():
+                batches.close()  # releases the cursor and the cluster slot
+                _finish_record(record, start, 'cancelled', country_stats=country_stats)
+                return
+    except (psycopg2_errors.QueryCanceled, QueryDeadlineExceeded) as e:
+        logger.warning(f"Timed out WARNING: {db_name}: {e}")
+        _finish_record(record, start, 'timeout', e, country_stats)
+        _put(events, ('timeout', db_name, f"Timed out after {time.monotonic() - start:.1f}s: {e}".strip()), stop)
+        return
     except psycopg2_errors.UndefinedTable as e:  # Catch table not found error
         logger.warning(f"Table not found WARNING: {e}")
-        return None  # Return None so that the main function can continue
-    except psycopg2_errors.Error as e:  # Catch other psycopg2 errors
-        logger.error(f"ERROR: {e}")
-        return None  # Return None so that the main function can continue
+        _finish_record(record, start, 'failed', e, country_stats)
+        _put(events, ('failed', db_name, str(e)), stop)
+        return
+    except Exception as e:  # Catch other errors so that the other countries can continue
+        logger.error(f"ERROR: {db_name}: {e}")
+        _finish_record(record, start, 'failed', e, country_stats)
+        _put(events, ('failed', db_name, str(e)), stop)
+        return
+
+    stats['seconds'] = time.monotonic() - start
+    _finish_record(record, start, 'done', country_stats=country_stats)
+    _put(events, ('done', db_name, stats), stop)
+
+
+def stream_select(code: str, countries: List[str], batch_size: int = None,
+                  timeout: float = None, country_stats: List = None) -> Iterator[Tuple[str, str, object]]:
+    """
+    Run the query over all selected countries and yield events as they arrive:
+
+    ('batch', db_name, RecordBatch) - next tagged batch of db_name rows
+    ('done', db_name, stats)        - db_name finished, stats holds rows/batches/seconds
+    ('failed', db_name, message)    - db_name failed, batches already yielded for it are incomplete
+    ('timeout', db_name, message)   - db_name did not finish within timeout seconds (incomplete too)
+
+    timeout defaults to settings.SEARCH_QUERY_TIMEOUT. When it passes, or the consumer
+    stops early, the statements still running on the countries are cancelled.
+    A telemetry record of every country is appended to country_stats, by default the
+    list of the enclosing search.telemetry.collect_country_stats() block, if any.
+    At most about one batch per running country is held in memory by the fan-out itself.
+    """
+    batch_size = batch_size or settings.SEARCH_FETCH_BATCH_SIZE
+    timeout = timeout or settings.SEARCH_QUERY_TIMEOUT
+    country_stats = country_stats if country_stats is not None else current_country_stats()
+
+    infos = [{"cluster": cluster,
+              "host": cluster_conn_info['host'],
+              "port": cluster_conn_info['port'],
+              "db_name": db_name,
+              "code": code}
+             for cluster, cluster_conn_info in connection_info.items()
+             for db_name in cluster_conn_info['dbs']
+             if db_name in countries]
+    if not infos:
+        return
+
+    # per-cluster limits are enforced by cluster_scheduler, the pool only has to be big enough
+    concurrency = cluster_scheduler.max_concurrency([info['cluster'] for info in infos])
+    events = queue.Queue(maxsize=concurrency)
+    stop = threading.Event()
+    deadline = time.monotonic() + timeout
+    cancellation = QueryCancellation()
+
+    with ThreadPoolExecutor(concurrency) as executor:
+        for info in infos:
+            executor.submit(_stream_country, info, batch_size, events, stop, deadline, cancellation, country_stats)
+
+        try:
+            remaining = len(infos)
+            while remaining:
+                try:
+                    event = events.get(timeout=max(0.1, deadline - time.monotonic()))
+                except queue.Empty:
+                    if not cancellation.cancelled:
+                        logger.warning(f"query deadline of {timeout}s passed, cancelling {remaining} countries")
+                        cancellation.cancel_all()
+                    continue
+                if event[0] != 'batch':
+                    remaining -= 1
+                yield event
+        finally:
+            # consumer stopped early: cancel what is still running and let the workers exit
+            stop.set()
+            cancellation.cancel_all()
+
+
+def save_result_to_dwh(result_table, customer_table_name: str) -> str:
+    logger.info(f"user provides custom table name to save into db: {customer_table_name}")
+    table_name = str(customer_table_name) + '_' + timezone.now().strftime("%Y%m%d_%H_%M_%S")
+
+    with DWH_LOAD_SECONDS.labels('query').time():
+        copy_to_db(result_table.to_batches(), table_name, schema='catopus')
+    return table_name
+
+
+# schema metadata key of a result table with the countries missing from it
+COUNTRY_STATUS_KEY = b'catopus.countries'
+
+
+def with_country_status(table: pa.Table, failed: Dict[str, str], timed_out: Dict[str, str]) -> pa.Table:
+    """Record the failed and timed out countries (with their messages) in the table's schema metadata."""
+    status = json.dumps({'failed': failed, 'timed_out': timed_out})
+    return table.replace_schema_metadata({**(table.schema.metadata or {}), COUNTRY_STATUS_KEY: status})
+
+
+def country_status(table: pa.Table) -> Dict[str, Dict[str, str]]:
+    metadata = table.schema.metadata or {}
+    if COUNTRY_STATUS_KEY not in metadata:
+        return {'failed': {}, 'timed_out': {}}
+    return json.loads(metadata[COUNTRY_STATUS_KEY])
 
 
 #  Run sql query over all selected countries
-def run_select(code: str, countries: List[str], customer_table_name : str=None) -> pd.DataFrame:
-    try: 
-        # processes = []
-        # result = Manager()
-        # results_list = result.list()
-        results_list = []
-
-        with ThreadPoolExecutor(8) as executor:
-            futures = []
-        
-            for cluster, cluster_conn_info in connection_info.items():
-                for db_name in cluster_conn_info['dbs']:
-                    if db_name in countries:                    
-                        info = {"host": cluster_conn_info['host'],
-                                    "port": cluster_conn_info['port'],
-                                    "db_name": db_name,
-                                    "code": code}
-                        future = executor.submit(exec_sql_multiproc, info)
-                        futures.append(future)
-
-            # start all processes
-            for future in as_completed(futures):
-                result = future.result()
-
-                if result is not None:
-                    results_list.append(result)
-
-            # create a dataframe with result
-            if len(results_list) == 0:
-                return pd.DataFrame({
-                    'result': 'None'
-                })
-            else:
-                result_df = pd.concat(results_list, ignore_index=True)
-
-                if customer_table_name:
-                    logger.info(f"user provides custom table name to save into db: {customer_table_name}")
-                    table_name = str(customer_table_name) + '_' + timezone.now().strftime("%Y%m%d_%H_%M_%S")
-
-                    result_df.to_sql(
-                        table_name,
-                        con=create_db_sqlalchemy_engine(
-                            settings.DATABASES['default']['HOST'],
-                            settings.DATABASES['default']['NAME'],
-                            settings.DATABASES['default']['USER'],
-                            settings.DATABASES['default']['PASSWORD']),
-                        schema='catopus',
-                        index=False,
-                        chunksize=10000)
-                    
-                    return result_df, table_name
+def run_select(code: str, countries: List[str], customer_table_name : str=None, timeout: float = None) -> ResultSpool:
+    # batches are kept by country until the query memory budget, then spilled to disk
+    result_spool = ResultSpool()
+    try:
+        missing = {'failed': {}, 'timeout': {}}
+
+        with FANOUT_SECONDS.labels('query').time():
+            for event, db_name, payload in stream_select(code, countries, timeout=timeout):
+                if event == 'batch':
+                    result_spool.add(payload, db_name)
+                elif event == 'done':
+                    result_spool.finish(db_name)
                 else:
-                    return result_df
+                    # partial rows of a failed or timed out country are dropped
+                    result_spool.discard(db_name)
+                    missing[event][db_name] = payload
+
+        # create a table with result, partial if some countries failed or timed out
+        if not result_spool.schema.names:
+            # no country finished, there aren't even columns to show
+            result_spool.close()
+            return with_country_status(pa.table({
+                'result': ['None']
+            }), missing['failed'], missing['timeout'])
+        else:
+            result_table = with_country_status(result_spool, missing['failed'], missing['timeout'])
+
+            if customer_table_name and result_table.num_rows:
+                return result_table, save_result_to_dwh(result_table, customer_table_name)
+            else:
+                return result_table
 
     except Exception as e:
-        logger.error(f"run_select ERROR: {e}")
\ No newline at end of file
+        result_spool.close()
+        logger.error(f"run_select ERROR: {e}")
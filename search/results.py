@@ -0,0 +1,338 @@
+import logging
+import math
+import os
+import shutil
+import tempfile
+import uuid
+from bisect import bisect_right
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from django.conf import settings
+
+logger = logging.getLogger('search')
+
+# parquet codecs that can be picked in settings.SEARCH_RESULT_STORAGE
+CODECS = ('zstd', 'snappy', 'lz4', 'gzip', 'none')
+
+
+def parquet_write_options(storage: Optional[Dict] = None) -> Dict:
+    """
+    Keyword arguments for pq.write_table/pq.ParquetWriter from settings.SEARCH_RESULT_STORAGE
+    (or the given storage options).
+    """
+    storage = {**getattr(settings, 'SEARCH_RESULT_STORAGE', {}), **(storage or {})}
+    compression = storage.get('compression', 'zstd')
+    if compression not in CODECS:
+        raise ValueError(f"Unsupported parquet compression: {compression}")
+
+    return {
+        'compression': compression,
+        'compression_level': storage.get('compression_level'),
+        'use_dictionary': storage.get('use_dictionary', True),
+        'write_statistics': storage.get('write_statistics', True),
+    }
+
+
+def write_result_table(table: pa.Table, sink, storage: Optional[Dict] = None):
+    """Write a query result in the configured storage format."""
+    storage = {**getattr(settings, 'SEARCH_RESULT_STORAGE', {}), **(storage or {})}
+    pq.write_table(table, sink, row_group_size=storage.get('row_group_size', 100_000),
+                   **parquet_write_options(storage))
+
+
+def _cast(column: pa.ChunkedArray, to: pa.DataType) -> pa.ChunkedArray:
+    # parquet gives back dictionary columns of non-string values (the _country_id tag) decoded
+    if pa.types.is_dictionary(to) and not pa.types.is_dictionary(column.type):
+        column = column.cast(to.value_type).dictionary_encode()
+    return column.cast(to)
+
+
+def _conform(table: pa.Table, schema: pa.Schema) -> pa.Table:
+    """Columns of table in the order and types of schema, missing ones as nulls (like a permissive concat)."""
+    columns = [_cast(table.column(field.name), field.type) if field.name in table.schema.names
+               else pa.nulls(table.num_rows, field.type) for field in schema]
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+def spill_root() -> str:
+    """Directory under MEDIA_ROOT for the temporary files of results being assembled."""
+    path = os.path.join(settings.MEDIA_ROOT, 'spill')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+class ResultSpool:
+    """
+    The country results of one query: kept in memory up to a budget (bytes, default
+    settings.SEARCH_QUERY_MEMORY_BUDGET), past it every buffered table is spilled to a
+    parquet file under MEDIA_ROOT. Countries come out in the order they were finished.
+
+    Has num_rows/schema/to_batches/replace_schema_metadata like the pa.Table it replaces.
+    """
+
+    def __init__(self, budget: Optional[int] = None):
+        self.budget = settings.SEARCH_QUERY_MEMORY_BUDGET if budget is None else budget
+        self.memory_bytes = 0
+        self.spilled_bytes = 0
+        self.metadata = {}
+        self._parts: Dict[str, List] = {}  # country -> pa.Table or spill file path, in arrival order
+        self._finished: List[str] = []
+        self._schemas: Dict[str, List[pa.Schema]] = {}
+        self._rows: Dict[str, int] = {}
+        self._spill_dir = None
+
+    @classmethod
+    def from_table(cls, table: pa.Table) -> 'ResultSpool':
+        spool = cls()
+        spool.add(table.replace_schema_metadata(None))
+        spool.finish()
+        spool.metadata = dict(table.schema.metadata or {})
+        return spool
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add(self, table, country: str = ''):
+        if isinstance(table, pa.RecordBatch):
+            table = pa.Table.from_batches([table])
+        self._parts.setdefault(country, []).append(table)
+        self._schemas.setdefault(country, []).append(table.schema)
+        self._rows[country] = self._rows.get(country, 0) + table.num_rows
+        self.memory_bytes += table.nbytes
+        if self.memory_bytes > self.budget:
+            self.spill()
+
+    def finish(self, country: str = ''):
+        """country is complete, its rows go into the result."""
+        if country in self._parts:
+            self._finished.append(country)
+
+    def discard(self, country: str):
+        """Drop the rows of a country that failed or timed out."""
+        for part in self._parts.pop(country, []):
+            if isinstance(part, str):
+                self.spilled_bytes -= os.path.getsize(part)
+                os.remove(part)
+            else:
+                self.memory_bytes -= part.nbytes
+        self._schemas.pop(country, None)
+        self._rows.pop(country, None)
+
+    def spill(self):
+        """Write the tables held in memory to parquet files, one per country."""
+        if self._spill_dir is None:
+            self._spill_dir = tempfile.mkdtemp(dir=spill_root())
+        logger.info(f"result spool: {self.memory_bytes} bytes over the budget of {self.budget}, spilling to {self._spill_dir}")
+
+        for country, parts in self._parts.items():
+            tables = [part for part in parts if not isinstance(part, str)]
+            if not tables:
+                continue
+            path = os.path.join(self._spill_dir, f"{country or 'result'}_{uuid.uuid4().hex}.parquet")
+            pq.write_table(pa.concat_tables(tables, promote_options='permissive'), path, compression='lz4')
+            self.spilled_bytes += os.path.getsize(path)
+            self.memory_bytes -= sum(table.nbytes for table in tables)
+            # every spill empties the memory, so a country's files always come before its tables
+            self._parts[country] = [part for part in parts if isinstance(part, str)] + [path]
+
+    @property
+    def num_rows(self) -> int:
+        return sum(self._rows[country] for country in self._finished)
+
+    @property
+    def schema(self) -> pa.Schema:
+        schemas = [schema for country in self._finished for schema in self._schemas[country]]
+        schema = pa.unify_schemas(schemas, promote_options='permissive') if schemas else pa.schema([])
+        return schema.with_metadata(self.metadata)
+
+    def replace_schema_metadata(self, metadata) -> 'ResultSpool':
+        self.metadata = dict(metadata or {})
+        return self
+
+    def _tables(self, schema: pa.Schema) -> Iterator[pa.Table]:
+        for country in self._finished:
+            for part in self._parts[country]:
+                if isinstance(part, str):
+                    for batch in pq.ParquetFile(part).iter_batches():
+                        yield _conform(pa.Table.from_batches([batch]), schema)
+                else:
+                    yield _conform(part, schema)
+
+    def to_batches(self) -> Iterator[pa.RecordBatch]:
+        schema = self.schema.remove_metadata()
+        for table in self._tables(schema):
+            yield from table.to_batches()
+
+    def head(self, rows: int) -> pa.Table:
+        schema = self.schema
+        tables, count = [], 0
+        for table in self._tables(schema.remove_metadata()):
+            if count >= rows:
+                break
+            tables.append(table.slice(0, rows - count))
+            count += tables[-1].num_rows
+        if not tables:
+            return schema.empty_table()
+        return pa.concat_tables(tables).replace_schema_metadata(schema.metadata)
+
+    def to_table(self) -> pa.Table:
+        """The whole result in memory, for small results."""
+        return self.head(self.num_rows)
+
+    def write_parquet(self, sink, storage: Optional[Dict] = None):
+        """The whole result through a single ParquetWriter, in row groups of the configured size."""
+        storage = {**getattr(settings, 'SEARCH_RESULT_STORAGE', {}), **(storage or {})}
+        row_group_size = storage.get('row_group_size', 100_000)
+        schema = self.schema
+
+        with pq.ParquetWriter(sink, schema, **parquet_write_options(storage)) as writer:
+            pending, pending_rows = [], 0
+            for table in self._tables(schema.remove_metadata()):
+                pending.append(table)
+                pending_rows += table.num_rows
+                if pending_rows >= row_group_size:
+                    merged = pa.concat_tables(pending)
+                    while merged.num_rows >= row_group_size:
+                        writer.write_table(merged.slice(0, row_group_size))
+                        merged = merged.slice(row_group_size)
+                    pending, pending_rows = [merged], merged.num_rows
+            if pending_rows:
+                writer.write_table(pa.concat_tables(pending))
+
+    def close(self):
+        if self._spill_dir is not None:
+            shutil.rmtree(self._spill_dir, ignore_errors=True)
+            self._spill_dir = None
+        self._parts, self._schemas, self._rows, self._finished = {}, {}, {}, []
+        self.memory_bytes = self.spilled_bytes = 0
+
+
+@contextmanager
+def open_result_file(search_result):
+    """
+    Open the parquet file of a SearchResult without reading it into memory. Files of a
+    storage with local paths (FileSystemStorage) are memory mapped, so the pages of the
+    row groups and columns read are the only ones loaded and arrow reads them in place.
+    """
+    result_file = search_result.search_results_file
+    try:
+        source = pa.memory_map(result_file.path, 'r')
+    except NotImplementedError:  # remote storage
+        result_file.open('rb')
+        source = result_file
+    try:
+        yield pq.ParquetFile(source)
+    finally:
+        source.close()
+
+
+def iter_row_groups(parquet: pq.ParquetFile, columns: Optional[List[str]] = None) -> Iterator[pa.Table]:
+    """The row groups of a stored result one at a time, with only the given columns."""
+    for i in range(parquet.num_row_groups):
+        yield parquet.read_row_group(i, columns=columns)
+
+
+def _row_group_starts(parquet: pq.ParquetFile):
+    starts = [0]
+    for i in range(parquet.num_row_groups):
+        starts.append(starts[-1] + parquet.metadata.row_group(i).num_rows)
+    return starts
+
+
+def _read_rows(parquet: pq.ParquetFile, rows: np.ndarray, columns: Optional[List[str]] = None) -> pa.Table:
+    """Read the given global row numbers (in the given order), touching only their row groups."""
+    starts = _row_group_starts(parquet)
+    groups = sorted({bisect_right(starts, row) - 1 for row in rows})
+    if not groups:
+        schema = parquet.schema_arrow
+        return pa.schema([schema.field(name) for name in columns]).empty_table() if columns else schema.empty_table()
+
+    table = parquet.read_row_groups(groups, columns=columns)
+    # position of each row inside the concatenation of the row groups read
+    offsets, position = {}, 0
+    for group in groups:
+        offsets[group] = position - starts[group]
+        position += starts[group + 1] - starts[group]
+    local = [row + offsets[bisect_right(starts, row) - 1] for row in rows]
+    return table.take(pa.array(local, pa.int64()))
+
+
+def read_result_page(parquet: pq.ParquetFile, offset: int = 0, limit: int = 100,
+                     sort: Optional[str] = None, descending: bool = False,
+                     columns: Optional[List[str]] = None) -> pa.Table:
+    """
+    Rows [offset, offset + limit) of a stored result, optionally ordered by one column and
+    restricted to some columns.
+
+    Without sort only the row groups overlapping the page are read. With sort, the sort
+    column is read in full to rank the rows, then only the row groups holding the page.
+    """
+    total = parquet.metadata.num_rows
+    offset = max(0, min(offset, total))
+    limit = max(0, min(limit, total - offset))
+
+    for name in [sort] + (columns or []):
+        if name is not None and name not in parquet.schema_arrow.names:
+            raise KeyError(name)
+
+    if sort is None or limit == 0:
+        rows = np.arange(offset, offset + limit)
+    else:
+        keys = parquet.read(columns=[sort])
+        if pa.types.is_dictionary(keys.schema.field(0).type):
+            # the ranking kernels don't take dictionary columns (the _country_code tag)
+            keys = keys.set_column(0, sort, keys.column(0).cast(keys.schema.field(0).type.value_type))
+        sort_keys = [(sort, 'descending' if descending else 'ascending')]
+        if offset + limit < total:
+            # top-k is enough for the page, only these rows get ordered
+            top = pc.select_k_unstable(keys, k=offset + limit, sort_keys=sort_keys)
+            ranked = top.take(pc.sort_indices(keys.take(top), sort_keys=sort_keys))
+        else:
+            ranked = pc.sort_indices(keys, sort_keys=sort_keys)
+        rows = ranked.to_numpy()[offset:offset + limit]
+
+    return _read_rows(parquet, rows, columns)
+
+
+def _json_values(column: pa.ChunkedArray) -> list:
+    """Python values of a column that JSON can carry: NaN/inf become null, bytes hex."""
+    values = column.to_pylist()
+    if pa.types.is_floating(column.type):
+        return [None if value is not None and not math.isfinite(value) else value for value in values]
+    if pa.types.is_binary(column.type) or pa.types.is_large_binary(column.type):
+        return [None if value is None else value.hex() for value in values]
+    return values
+
+
+def table_to_page(table: pa.Table, offset: int, total_rows: int) -> Dict:
+    """Compact JSON page: column names once and the rows as lists."""
+    columns = [_json_values(column) for column in table.columns]
+    return {
+        'columns': table.schema.names,
+        'rows': [list(row) for row in zip(*columns)],
+        'offset': offset,
+        'total_rows': total_rows,
+    }
+
+
+def table_to_columns(table: pa.Table, offset: int, total_rows: int) -> Dict:
+    """
+    Columnar JSON page: a schema header (name and arrow type of every column), then one
+    list of values per column, rendered by the browser instead of a server-side to_html.
+    """
+    return {
+        'schema': [{'name': field.name, 'type': str(field.type)} for field in table.schema],
+        'columns': [_json_values(column) for column in table.columns],
+        'num_rows': table.num_rows,
+        'offset': offset,
+        'total_rows': total_rows,
+    }
@@ -0,0 +1,158 @@
+import logging
+import threading
+import time
+
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from .metrics import CLUSTER_IN_FLIGHT
+
+logger = logging.getLogger('search')
+
+
+class ClusterLimiter:
+    """
+    AIMD concurrency limit for a single cluster host.
+
+    Every successful query grows the limit by 1/limit (so roughly +1 per "window" of
+    limit queries); a query that errors with an overload-type error, or is much slower
+    than the recent average (and slower than `min_slow_latency` seconds), multiplies the
+    limit by `backoff`. Decreases are rate limited by `cooldown` so one burst of slow
+    countries only backs off once.
+
+    With share > 1 the limiter only gets 1/share of initial and max_limit (but at least
+    min_limit), for clusters that several processes query independently.
+    """
+
+    def __init__(self, name, initial=4, min_limit=1, max_limit=16, backoff=0.5,
+                 latency_tolerance=2.0, min_slow_latency=1.0, ewma_alpha=0.2, cooldown=5.0, share=1):
+        self.name = name
+        self.limit = float(max(min_limit, initial // share))
+        self.min_limit = min_limit
+        self.max_limit = max(min_limit, max_limit // share)
+        self.backoff = backoff
+        self.latency_tolerance = latency_tolerance
+        self.min_slow_latency = min_slow_latency
+        self.ewma_alpha = ewma_alpha
+        self.cooldown = cooldown
+
+        self.in_flight = 0
+        self.ewma_latency = None
+        self.completed = 0
+        self.errors = 0
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+
+    def release(self, latency, overloaded=False):
+        with self._cond:
+            self.in_flight -= 1
+            self.completed += 1
+
+            slow = self.ewma_latency is not None and latency > self.min_slow_latency and \
+                latency > self.ewma_latency * self.latency_tolerance
+            if overloaded:
+                self.errors += 1
+
+            if overloaded or slow:
+                self._decrease(latency)
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+            if not overloaded:
+                self.ewma_latency = latency if self.ewma_latency is None else \
+                    self.ewma_alpha * latency + (1 - self.ewma_alpha) * self.ewma_latency
+
+            self._cond.notify_all()
+
+    def _decrease(self, latency):
+        now = time.monotonic()
+        if now - self._last_decrease < self.cooldown:
+            return
+        self._last_decrease = now
+
+        new_limit = max(self.min_limit, self.limit * self.backoff)
+        if int(new_limit) < int(self.limit):
+            logger.info(f"scheduler: backing off cluster {self.name} "
+                        f"{int(self.limit)} -> {int(new_limit)} (latency {latency:.2f}s)")
+        self.limit = new_limit
+
+    def stats(self):
+        with self._cond:
+            return {'limit': int(self.limit),
+                    'in_flight': self.in_flight,
+                    'ewma_latency': self.ewma_latency,
+                    'completed': self.completed,
+                    'errors': self.errors}
+
+
+class Slot:
+    def __init__(self):
+        self.overloaded = False
+        self.latency = None
+
+    def mark_overloaded(self):
+        self.overloaded = True
+
+    def observe(self, latency):
+        # latency to feed the limiter instead of the time the slot was held,
+        # e.g. time to first batch for streamed results
+        self.latency = latency
+
+
+class ClusterScheduler:
+    """
+    Per-cluster concurrency limits for the country fan-out, shared by all requests
+    running in this process.
+
+    Options come from settings.SEARCH_CLUSTER_CONCURRENCY: the 'default' entry applies
+    to every cluster and can be overridden per cluster name from search.config. They are
+    limits for the whole deployment: every gunicorn and celery worker process has its own
+    scheduler, so each one gets 1/processes of them (settings.SEARCH_CLUSTER_PROCESSES).
+    """
+
+    def __init__(self, options=None, processes=None):
+        self._options = options if options is not None else getattr(settings, 'SEARCH_CLUSTER_CONCURRENCY', {})
+        self._processes = processes or getattr(settings, 'SEARCH_CLUSTER_PROCESSES', 1)
+        self._limiters = {}
+        self._lock = threading.Lock()
+
+    def limiter(self, cluster):
+        with self._lock:
+            if cluster not in self._limiters:
+                options = {**self._options.get('default', {}), **self._options.get(cluster, {})}
+                self._limiters[cluster] = ClusterLimiter(cluster, share=self._processes, **options)
+            return self._limiters[cluster]
+
+    def max_concurrency(self, clusters):
+        """Upper bound of concurrently running queries over the given clusters."""
+        return sum(self.limiter(cluster).max_limit for cluster in set(clusters)) or 1
+
+    @contextmanager
+    def slot(self, cluster):
+        limiter = self.limiter(cluster)
+        limiter.acquire()
+        CLUSTER_IN_FLIGHT.labels(cluster).inc()
+
+        slot = Slot()
+        start = time.monotonic()
+        try:
+            yield slot
+        finally:
+            CLUSTER_IN_FLIGHT.labels(cluster).dec()
+            latency = slot.latency if slot.latency is not None else time.monotonic() - start
+            limiter.release(latency, slot.overloaded)
+
+    def stats(self):
+        with self._lock:
+            limiters = list(self._limiters.values())
+        return {limiter.name: limiter.stats() for limiter in limiters}
+
+
+cluster_scheduler = ClusterScheduler()
@@ -1,21 +1,29 @@
 import logging
 import os
-import pandas as pd
+import shutil
+import tempfile
+import time
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from django.utils import timezone
 
 from celery import shared_task
-from multiprocessing import Process
-from multiprocessing import Queue, Manager
+from psycopg2 import errors as psycopg2_errors
 
 from datetime import datetime
 from dotenv import load_dotenv
 from django.conf import settings
 
 # custom modules
-from .config import connection_info, map_country_code_to_id as code_to_id
-from catopus.utils.database import create_db_sqlalchemy_engine
-from sqlalchemy import text
+from .config import connection_info
+from .multiprocessing import QueryDeadlineExceeded, exec_sql_multiproc
+from .metrics import DWH_LOAD_SECONDS, REMOTE_JOB_SECONDS, record_country_query
+from .results import parquet_write_options
+from .telemetry import new_country_record, save_country_stats
+from catopus.utils.database import copy_to_db
 
 logger = logging.getLogger('search')
 
@@ -23,86 +31,171 @@ load_dotenv()
 
 
 
-def exec_sql_remote(query, results_list):
-    try:
-        get_query = query.get()
-
-        df = pd.read_sql_query(sql=text(get_query['code']),
-                               con=create_db_sqlalchemy_engine(get_query['host'],
-                                                                get_query['db_name'],
-                                                                settings.REMOTE_DB_USER,
-                                                                settings.REMOTE_DB_PASSWORD))
-
-        columns = list(df.columns)
-        copy_df = df.copy()
-        copy_df['_country_code'] = get_query['db_name']
-        copy_df['_country_id'] = code_to_id[get_query['db_name']]
-        final_df = copy_df[['_country_id', '_country_code', *columns]]
+def _spill_batches(batches, spill_dir, db_name):
+    """
+    Write a country's record batches to parquet files in spill_dir, one batch at a time.
 
-        results_list.append(final_df)
+    A batch whose schema can't be cast to the current file's (e.g. an all-null column
+    in the first batch) starts a new file. Returns the file paths and rows/bytes written.
+    """
+    paths = []
+    stats = {'rows': 0, 'bytes': 0}
+    writer = None
+    try:
+        for batch in batches:
+            table = pa.Table.from_batches([batch])
+            if writer is not None and not table.schema.equals(writer.schema):
+                try:
+                    table = table.cast(writer.schema)
+                except (pa.ArrowInvalid, pa.ArrowNotImplementedError, ValueError):
+                    writer.close()
+                    writer = None
+
+            if writer is None:
+                paths.append(os.path.join(spill_dir, f"{db_name}_{len(paths)}.parquet"))
+                writer = pq.ParquetWriter(paths[-1], table.schema, **parquet_write_options())
+            writer.write_table(table)
+            stats['rows'] += table.num_rows
+            stats['bytes'] += table.nbytes
+    finally:
+        if writer is not None:
+            writer.close()
+    return paths, stats
+
+
+def exec_sql_remote(info, spill_dir):
+    """
+    Run the query on one country (in a pool thread) and spill its result to parquet files.
+    Returns db_name, status, progress stats, file paths and the country's telemetry record.
+    """
+    start = time.monotonic()
+    deadline = start + settings.REMOTE_QUERY_TIMEOUT if settings.REMOTE_QUERY_TIMEOUT else None
+    record = new_country_record(info)
+    try:
+        paths, stats = _spill_batches(exec_sql_multiproc(info, settings.SEARCH_FETCH_BATCH_SIZE, deadline, record=record),
+                                      spill_dir, info['db_name'])
+        status, stats = 'done', {**stats, 'seconds': time.monotonic() - start}
+    except (psycopg2_errors.QueryCanceled, QueryDeadlineExceeded) as e:
+        logger.warning(f"exec_sql_remote: {info['db_name']} timed out: {e}")
+        paths, record['error_class'] = [], type(e).__name__
+        status, stats = 'timeout', {'message': f"Timed out: {e}".strip(), 'seconds': time.monotonic() - start}
     except Exception as e:
         logger.error(f"exec_sql_remote: {e}")
+        paths, record['error_class'] = [], type(e).__name__
+        status, stats = 'failed', {'message': str(e), 'seconds': time.monotonic() - start}
 
+    record['status'] = status
+    record['total_seconds'] = time.monotonic() - start
+    record_country_query(record)
+    return info['db_name'], status, stats, paths, record
 
-@shared_task
-def run_sql_query_remotely(rmt_user, rmt_input_code, rmt_countries, rmt_countries_list=None):
-    from .models import RemoteLogs
 
-    try:
-        # Change status of run query to "running" and save info to dwh
-        log_remote = RemoteLogs(user=rmt_user,
-                                status="start",
-                                sql_query=rmt_input_code,
-                                countries_list=rmt_countries_list,
-                                countries=rmt_countries)
-        log_remote.save()
+def _country_pool(workers):
+    # threads: the task runs in a daemonic celery (prefork) worker process, which can't
+    # start child processes, and the country queries mostly wait on postgres anyway
+    return ThreadPoolExecutor(max_workers=workers, thread_name_prefix='remote-country')
+
 
-        # Run sql query over all selected countries
-        processes = []
-        result = Manager()
-        results_list = result.list() # stores all dfs
+def _read_spilled(paths):
+    # one row group at a time, the parent never holds more than that of the result
+    for path in paths:
+        parquet = pq.ParquetFile(path)
+        for i in range(parquet.num_row_groups):
+            yield parquet.read_row_group(i)
 
-        for cluster, cluster_conn_info in connection_info.items():
-            for db_name in cluster_conn_info['dbs']:
-                if db_name in rmt_countries:
 
-                    query = Queue()
-                    info = {"host": cluster_conn_info['host'],
-                            "port": cluster_conn_info['port'],
-                            "db_name": db_name,
-                            "code": rmt_input_code}
-                    query.put(info)
+def _record_progress(log_remote, db_name, status, stats):
+    from .models import RemoteCountryProgress
 
-                    process = Process(target=exec_sql_remote, args=(query, results_list, ))
-                    processes.append(process)
+    RemoteCountryProgress.objects.filter(remote_log=log_remote, country=db_name).update(
+        status=status, updated_on=timezone.now(), **stats)
 
-        # start all processes
-        for process in processes:
-            process.start()
 
-        for process in processes:
-            process.join()
+@shared_task
+def run_sql_query_remotely(remote_log_id):
+    from .models import RemoteCountryProgress, RemoteLogs
+
+    log_remote = RemoteLogs.objects.get(id=remote_log_id)
+    rmt_input_code = log_remote.sql_query
+    rmt_countries = log_remote.countries
+    spill_dir = tempfile.mkdtemp(prefix=f"catopus_rmt_{remote_log_id}_", dir=settings.REMOTE_SPILL_DIR)
+    job_start = time.monotonic()
 
-        if len(results_list) == 0:
+    try:
+        # Change status of run query to "start"
+        log_remote.status = "start"
+        log_remote.save(update_fields=['status'])
+
+        infos = [{"cluster": cluster,
+                  "host": cluster_conn_info['host'],
+                  "port": cluster_conn_info['port'],
+                  "db_name": db_name,
+                  "code": rmt_input_code}
+                 for cluster, cluster_conn_info in connection_info.items()
+                 for db_name in cluster_conn_info['dbs']
+                 if db_name in rmt_countries]
+
+        table_name = str(log_remote.user_id) + '_rmt_' + timezone.now().strftime("%Y%m%d_%H_%M_%S")
+        streaming = settings.REMOTE_STREAMING_INGEST
+
+        # Run sql query over all selected countries, at most REMOTE_MAX_WORKERS at a time;
+        # each country is written to its own files, only their paths come back
+        country_files = {}
+        finished = {'done': 0, 'failed': 0}
+        loaded = 0
+        country_stats = []
+        if infos:
+            with _country_pool(min(settings.REMOTE_MAX_WORKERS, len(infos))) as pool:
+                futures = [pool.submit(exec_sql_remote, info, spill_dir) for info in infos]
+                for future in as_completed(futures):
+                    db_name, status, stats, paths, record = future.result()
+                    country_stats.append(record)
+                    country_files[db_name] = paths
+
+                    if streaming and status == 'done' and stats['rows']:
+                        # load the country while the others are still running
+                        try:
+                            with DWH_LOAD_SECONDS.labels('remote').time():
+                                copy_to_db(_read_spilled(paths), table_name, schema='catopus', append=loaded > 0)
+                            loaded += 1
+                            status = 'loaded'
+                        except Exception as e:
+                            logger.error(f"run_sql_query_remotely: loading {db_name} into {table_name}: {e}")
+                            status, stats = 'failed', {**stats, 'message': f"Loading into {table_name} failed: {e}"}
+                        finally:
+                            for path in paths:
+                                os.remove(path)
+
+                        if loaded == 1 and status == 'loaded':
+                            log_remote.table_name_created = table_name
+
+                    finished['failed' if status in ('failed', 'timeout') else 'done'] += 1
+                    _record_progress(log_remote, db_name, status, stats)
+
+                    log_remote.step = f"{finished['done']} of {len(infos)} countries done" + \
+                        (f", {finished['failed']} failed" if finished['failed'] else '') + \
+                        (f", {loaded} loaded" if streaming else '')
+                    log_remote.save(update_fields=['step', 'table_name_created'])
+
+        # countries that never reported (unknown country code)
+        RemoteCountryProgress.objects.filter(remote_log=log_remote, status='pending').update(
+            status='failed', message='No result reported', updated_on=timezone.now())
+        save_country_stats(country_stats, log_remote.user, str(log_remote.id), source='remote')
+
+        if not streaming:
+            paths = [path for info in infos for path in country_files.get(info['db_name'], [])]
+            if sum(pq.ParquetFile(path).metadata.num_rows for path in paths):
+                with DWH_LOAD_SECONDS.labels('remote').time():
+                    copy_to_db(_read_spilled(paths), table_name, schema='catopus')
+                loaded = 1
+
+        if not loaded:
             # If empty result, update system table with appropriate info
             log_remote.status = "empty"
+            log_remote.table_name_created = None
             log_remote.updated_on = timezone.now()
             log_remote.save()
         else:
-            res_df = pd.concat(results_list, ignore_index=True)
-            table_name = str(rmt_user) + '_rmt_' + timezone.now().strftime("%Y%m%d_%H_%M_%S")
-
-            res_df.to_sql(
-                table_name,
-                con=create_db_sqlalchemy_engine(
-                    settings.DATABASES['default']['HOST'],
-                    settings.DATABASES['default']['NAME'],
-                    settings.DATABASES['default']['USER'],
-                    settings.DATABASES['default']['PASSWORD']),
-                schema='catopus',
-                index=False,
-                chunksize=10000)
-
             log_remote.status = "finished"
             log_remote.table_name_created = table_name
             log_remote.updated_on = timezone.now()
@@ -114,4 +207,7 @@ def run_sql_query_remotely(rmt_user, rmt_input_code, rmt_countries, rmt_countrie
         log_remote.status = "error"
         log_remote.log_field = e
         log_remote.updated_on = timezone.now()
-        log_remote.save()
\ No newline at end of file
+        log_remote.save()
+    finally:
+        shutil.rmtree(spill_dir, ignore_errors=True)
+        REMOTE_JOB_SECONDS.labels(log_remote.status).observe(time.monotonic() - job_start)
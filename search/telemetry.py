@@ -0,0 +1,91 @@
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import timedelta
+from typing import Dict, List, Optional
+
+from django.db.models import Aggregate, Count, FloatField, Q, Sum
+from django.utils import timezone
+
+logger = logging.getLogger('search')
+
+# per-country records of the fan-outs running in the current request, see collect_country_stats
+_country_stats: ContextVar[Optional[List[Dict]]] = ContextVar('country_stats', default=None)
+
+
+def new_country_record(info: Dict[str, str]) -> Dict:
+    """Timings/sizes of one country execution, filled in by exec_sql_multiproc."""
+    return {'country': info['db_name'],
+            'cluster': info['cluster'],
+            'status': 'done',
+            'connect_seconds': None,
+            'execute_seconds': None,
+            'fetch_seconds': None,
+            'total_seconds': 0.0,
+            'rows': 0,
+            'bytes': 0,
+            'error_class': None}
+
+
+@contextmanager
+def collect_country_stats():
+    """Collect the country records of every stream_select started inside the block."""
+    records = []
+    token = _country_stats.set(records)
+    try:
+        yield records
+    finally:
+        _country_stats.reset(token)
+
+
+def current_country_stats() -> Optional[List[Dict]]:
+    return _country_stats.get()
+
+
+def save_country_stats(records: List[Dict], user=None, identifier=None, source='query'):
+    """Write the records of one request/job in a single insert."""
+    from .models import CountryQueryStats
+
+    if not records:
+        return
+    try:
+        CountryQueryStats.objects.bulk_create(
+            CountryQueryStats(user=user, identifier=identifier, source=source, **record) for record in records)
+    except Exception as e:  # telemetry must never fail the query itself
+        logger.error(f"save_country_stats: {e}")
+
+
+class Percentile(Aggregate):
+    # postgres ordered-set aggregate
+    function = 'percentile_cont'
+    template = '%(function)s(%(percentile)s) WITHIN GROUP (ORDER BY %(expressions)s)'
+    output_field = FloatField()
+
+    def __init__(self, expression, percentile, **extra):
+        super().__init__(expression, percentile=float(percentile), **extra)
+
+
+def aggregate_country_stats(group_by: str, days: int = 7) -> List[Dict]:
+    """p50/p95 timings, runs, errors, cancellations and volume per country or per cluster over the last days."""
+    from .models import CountryQueryStats
+
+    return list(
+        CountryQueryStats.objects
+        .filter(created_at__gte=timezone.now() - timedelta(days=days))
+        .values(group_by)
+        .annotate(runs=Count('id'),
+                  # cancelled runs (client gone, stopped stream) are not the country's fault
+                  errors=Count('id', filter=~Q(status__in=('done', 'cancelled'))),
+                  timeouts=Count('id', filter=Q(status='timeout')),
+                  cancelled=Count('id', filter=Q(status='cancelled')),
+                  p50_total=Percentile('total_seconds', 0.5),
+                  p95_total=Percentile('total_seconds', 0.95),
+                  p50_connect=Percentile('connect_seconds', 0.5),
+                  p95_connect=Percentile('connect_seconds', 0.95),
+                  p50_execute=Percentile('execute_seconds', 0.5),
+                  p95_execute=Percentile('execute_seconds', 0.95),
+                  p50_fetch=Percentile('fetch_seconds', 0.5),
+                  p95_fetch=Percentile('fetch_seconds', 0.95),
+                  rows=Sum('rows'),
+                  bytes=Sum('bytes'))
+        .order_by('-p95_total'))
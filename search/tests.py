@@ -1,14 +1,43 @@
-from django.test import TestCase, Client
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.test import SimpleTestCase, TestCase, Client, override_settings
+from django.core.cache import caches
+from django.core.files.base import ContentFile
+from django.utils import timezone
 from django.urls import reverse
 from django.contrib.auth import get_user_model
 from unittest.mock import patch, MagicMock
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 from io import BytesIO
+from collections import namedtuple
+import billiard
+from decimal import Decimal
+from psycopg2 import errors as psycopg2_errors
+from sqlalchemy import exc as sqlalchemy_exc
 from django.http import JsonResponse # For type checking if needed
-from search.models import SearchResult # To check instance creation
+from search.models import CountryQueryStats, RemoteCountryProgress, RemoteLogs, SearchResult # To check instance creation
+from search.tasks import _country_pool, run_sql_query_remotely
+from search.telemetry import aggregate_country_stats, collect_country_stats
+from catopus.utils.database import EngineRegistry, arrow_type_to_postgres
+from search.scheduler import ClusterLimiter, ClusterScheduler, cluster_scheduler
+from search.cache import cache_result, normalize_sql, query_fingerprint
+from search.views import save_table_to_db
+from search.results import ResultSpool, parquet_write_options, table_to_columns, write_result_table
+from search.multiprocessing import QueryCancellation, country_status, country_tag_arrays, exec_sql_multiproc, rows_to_record_batch, run_select, stream_select, with_country_status
 
 User = get_user_model()
 
+# cursor.description entry: column name and postgres type oid
+Column = namedtuple('Column', ['name', 'type_code'])
+
 class IndexViewSyncQueryTests(TestCase):
 
     def setUp(self):
@@ -56,7 +85,7 @@ class IndexViewSyncQueryTests(TestCase):
         mock_df_data = {'col1': [1, 2], 'col2': ['data1', 'data2']}
         mock_df = pd.DataFrame(mock_df_data)
 
-        mock_run_select.return_value = (mock_df, None) # (result_df, a_priori_table_name)
+        mock_run_select.return_value = (pa.Table.from_pandas(mock_df), None) # (result_table, a_priori_table_name)
         mock_file_field_save.return_value = None # search_results_file.save(...) doesn't need to return anything specific
 
         query_data = {
@@ -71,7 +100,8 @@ class IndexViewSyncQueryTests(TestCase):
         mock_run_select.assert_called_once_with(
             query_data['query'],
             query_data['selected_countries'],
-            query_data['custom_user_table_name']
+            query_data['custom_user_table_name'],
+            timeout=settings.SEARCH_QUERY_TIMEOUT
         )
 
         # Check that a SearchResult was created (implicitly, file was saved)
@@ -97,10 +127,9 @@ class IndexViewSyncQueryTests(TestCase):
     @patch('search.views.run_select')
     def test_handle_query_execution_empty_dataframe_result(self, mock_run_select):
         """
-        Test _handle_query_execution when run_select returns an empty DataFrame.
+        Test _handle_query_execution when run_select returns an empty table.
         """
-        empty_df = pd.DataFrame()
-        mock_run_select.return_value = (empty_df, None)
+        mock_run_select.return_value = (pa.table({}), None)
 
         query_data = {
             'query': 'SELECT * FROM non_existent_table',
@@ -127,3 +156,775 @@ class IndexViewSyncQueryTests(TestCase):
         # If SearchResult objects were created and not cleaned by transaction rollback (e.g. if file saving had side effects not in DB)
         # SearchResult.objects.all().delete() # But this is usually not needed.
         pass
+
+
+class EngineRegistryTests(SimpleTestCase):
+
+    def test_engine_is_reused_per_host_and_db(self):
+        registry = EngineRegistry(idle_timeout=None)
+        engine_de = registry.get_engine('10.0.1.65', 'de', 'user', 'password')
+
+        self.assertIs(registry.get_engine('10.0.1.65', 'de', 'user', 'password'), engine_de)
+        self.assertIsNot(registry.get_engine('10.0.1.65', 'pl', 'user', 'password'), engine_de)
+
+        stats = registry.stats()
+        self.assertEqual(stats['de@10.0.1.65']['hits'], 2)
+        self.assertEqual(stats['pl@10.0.1.65']['hits'], 1)
+        registry.dispose_all()
+
+    def test_idle_engines_are_evicted(self):
+        registry = EngineRegistry(idle_timeout=60)
+        registry.get_engine('10.0.1.65', 'de', 'user', 'password')
+
+        with patch('catopus.utils.database.time.time', return_value=10 ** 12):
+            registry.evict_idle()
+
+        self.assertEqual(registry.stats(), {})
+
+
+class ClusterSchedulerTests(SimpleTestCase):
+
+    def test_limit_grows_additively_on_fast_queries(self):
+        limiter = ClusterLimiter('nl', initial=4, max_limit=8)
+        for _ in range(8):
+            limiter.acquire()
+            limiter.release(1.0)
+
+        self.assertEqual(limiter.stats()['limit'], 5)
+        self.assertEqual(limiter.stats()['in_flight'], 0)
+
+    def test_limit_backs_off_on_overload_and_slow_queries(self):
+        limiter = ClusterLimiter('us', initial=8, backoff=0.5, cooldown=0)
+        limiter.acquire()
+        limiter.release(1.0, overloaded=True)
+        self.assertEqual(limiter.stats()['limit'], 4)
+
+        limiter.acquire()
+        limiter.release(1.0)
+        limiter.acquire()
+        limiter.release(10.0)  # much slower than the running average
+        self.assertEqual(limiter.stats()['limit'], 2)
+
+    def test_options_are_merged_per_cluster(self):
+        scheduler = ClusterScheduler({'default': {'initial': 2, 'max_limit': 4}, 'nl': {'max_limit': 10}}, processes=1)
+
+        self.assertEqual(scheduler.max_concurrency(['nl', 'us']), 14)
+        with scheduler.slot('nl'):
+            self.assertEqual(scheduler.stats()['nl']['in_flight'], 1)
+        self.assertEqual(scheduler.stats()['nl']['in_flight'], 0)
+
+    def test_limits_are_split_between_worker_processes(self):
+        scheduler = ClusterScheduler({'default': {'initial': 8, 'max_limit': 16}, 'us': {'max_limit': 2}}, processes=4)
+
+        self.assertEqual(scheduler.stats(), {})
+        self.assertEqual(scheduler.limiter('nl').stats()['limit'], 2)
+        self.assertEqual(scheduler.limiter('nl').max_limit, 4)
+        # never below min_limit, or a process could not query the cluster at all
+        self.assertEqual(scheduler.limiter('us').max_limit, 1)
+
+    def test_refused_connection_backs_off_the_cluster(self):
+        scheduler = ClusterScheduler({'default': {'initial': 4, 'cooldown': 0}}, processes=1)
+        info = {'cluster': 'nl', 'host': '127.0.0.1', 'port': 1, 'db_name': 'nl', 'code': 'SELECT 1'}
+
+        with patch('search.multiprocessing.cluster_scheduler', scheduler):
+            with self.assertRaises(sqlalchemy_exc.OperationalError):
+                list(exec_sql_multiproc(info, 10))
+
+        self.assertEqual(scheduler.stats()['nl']['errors'], 1)
+        self.assertEqual(scheduler.stats()['nl']['limit'], 2)
+
+
+class StreamSelectTests(SimpleTestCase):
+
+    @staticmethod
+    def fake_exec_sql(info, batch_size, deadline=None, cancellation=None, record=None):
+        if info['db_name'] == 'pl':
+            yield rows_to_record_batch([(1, )], [Column('value', 23)], 'pl')
+            raise RuntimeError('connection lost')
+        for start in range(0, 5, batch_size):
+            rows = [(value, ) for value in range(start, min(start + batch_size, 5))]
+            yield rows_to_record_batch(rows, [Column('value', 23)], 'de')
+
+    @patch('search.multiprocessing.exec_sql_multiproc')
+    def test_stream_select_yields_batches_and_country_events(self, mock_exec_sql):
+        mock_exec_sql.side_effect = self.fake_exec_sql
+
+        events = list(stream_select('SELECT 1', ['de', 'pl'], batch_size=2))
+
+        de_batches = [payload.num_rows for event, db_name, payload in events if event == 'batch' and db_name == 'de']
+        self.assertEqual(de_batches, [2, 2, 1])
+        self.assertIn(('failed', 'pl', 'connection lost'), events)
+        done = [payload for event, db_name, payload in events if event == 'done']
+        self.assertEqual(len(done), 1)
+        self.assertEqual(done[0]['rows'], 5)
+
+    @patch('search.multiprocessing.exec_sql_multiproc')
+    def test_run_select_drops_partial_results_of_failed_countries(self, mock_exec_sql):
+        mock_exec_sql.side_effect = self.fake_exec_sql
+
+        result_table = run_select('SELECT 1', ['de', 'pl']).to_table()
+
+        self.assertEqual(result_table.column('_country_code').unique().to_pylist(), ['de'])
+        self.assertEqual(result_table.num_rows, 5)
+
+    @patch('search.multiprocessing.exec_sql_multiproc')
+    def test_run_select_keeps_the_columns_of_an_empty_result(self, mock_exec_sql):
+        mock_exec_sql.side_effect = lambda info, *args, **kwargs: iter(
+            [rows_to_record_batch([], [Column('value', 23)], info['db_name'])])
+
+        result_table = run_select('SELECT 1 WHERE false', ['de', 'pl'])
+
+        self.assertEqual(result_table.num_rows, 0)
+        self.assertEqual(result_table.schema.names, ['_country_id', '_country_code', 'value'])
+        result_table.close()
+
+    @patch('search.multiprocessing.get_pooled_engine')
+    def test_only_declarable_statements_use_a_named_cursor(self, mock_get_engine):
+        connection = mock_get_engine.return_value.raw_connection.return_value
+        cursor = connection.cursor.return_value
+        cursor.description = [Column('work_mem', 25)]
+        cursor.fetchmany.side_effect = [[('4MB', )], []]
+        info = {'cluster': 'de', 'host': 'localhost', 'db_name': 'de', 'code': 'SHOW work_mem'}
+
+        batches = list(exec_sql_multiproc(info, 10))
+
+        connection.cursor.assert_called_with()
+        self.assertEqual(batches[0].column('work_mem').to_pylist(), ['4MB'])
+
+        connection.cursor.reset_mock()
+        cursor.fetchmany.side_effect = [[]]
+        list(exec_sql_multiproc({**info, 'code': '-- ids\nWITH t AS (SELECT 1) SELECT * FROM t'}, 10))
+
+        self.assertIn('name', connection.cursor.call_args.kwargs)
+
+    @staticmethod
+    def fake_exec_sql_slow_pl(info, batch_size, deadline=None, cancellation=None, record=None):
+        if info['db_name'] == 'pl':
+            # a statement that only ends when it is cancelled
+            cancelled = threading.Event()
+            cancellation.register('pl', MagicMock(**{'dbapi_connection.cancel.side_effect': cancelled.set}))
+            cancelled.wait(5)
+            raise psycopg2_errors.QueryCanceled('canceling statement due to user request')
+        yield rows_to_record_batch([(1, )], [Column('value', 23)], 'de')
+
+    @override_settings(SEARCH_QUERY_TIMEOUT=0.3)
+    @patch('search.multiprocessing.exec_sql_multiproc')
+    def test_countries_past_the_deadline_are_cancelled_and_marked(self, mock_exec_sql):
+        mock_exec_sql.side_effect = self.fake_exec_sql_slow_pl
+
+        result_table = run_select('SELECT 1', ['de', 'pl']).to_table()
+
+        self.assertEqual(result_table.column('_country_code').to_pylist(), ['de'])
+        self.assertEqual(list(country_status(result_table)['timed_out']), ['pl'])
+
+    @patch('search.multiprocessing.exec_sql_multiproc')
+    def test_closing_the_stream_cancels_running_countries(self, mock_exec_sql):
+        mock_exec_sql.side_effect = self.fake_exec_sql_slow_pl
+        events = stream_select('SELECT 1', ['de', 'pl'], timeout=60)
+
+        next(events)
+        start = time.monotonic()
+        events.close()
+
+        self.assertLess(time.monotonic() - start, 2)
+
+    def test_cancel_is_sent_before_the_connection_can_be_released(self):
+        cancellation = QueryCancellation()
+        connection = MagicMock()
+        connection.dbapi_connection.cancel.side_effect = lambda: self.assertTrue(cancellation._lock.locked())
+        cancellation.register('de', connection)
+
+        cancellation.cancel_all()
+
+        connection.dbapi_connection.cancel.assert_called_once()
+        self.assertTrue(cancellation.cancelled)
+
+    @patch('search.multiprocessing.exec_sql_multiproc')
+    def test_country_records_are_collected(self, mock_exec_sql):
+        mock_exec_sql.side_effect = self.fake_exec_sql
+
+        with collect_country_stats() as country_stats:
+            run_select('SELECT 1', ['de', 'pl'])
+
+        records = {record['country']: record for record in country_stats}
+        self.assertEqual(records['de']['status'], 'done')
+        self.assertEqual((records['pl']['status'], records['pl']['error_class']), ('failed', 'RuntimeError'))
+
+    def test_rows_to_record_batch_tags_country_and_converts_postgres_types(self):
+        rows = [(1, Decimal('1.50'), {'a': 1}), (2, None, None)]
+        description = [Column('id', 20), Column('amount', 1700), Column('payload', 3802)]
+
+        batch = rows_to_record_batch(rows, description, 'de')
+
+        self.assertEqual(batch.schema.names, ['_country_id', '_country_code', 'id', 'amount', 'payload'])
+        self.assertEqual(batch.column(0).to_pylist(), [2, 2])
+        self.assertEqual(batch.column(1).to_pylist(), ['de', 'de'])
+        self.assertEqual(batch.column(3).to_pylist(), [1.5, None])
+        self.assertEqual(batch.column(4).to_pylist(), ['{"a": 1}', None])
+
+
+class CountryTaggingTests(SimpleTestCase):
+
+    def test_arrow_tags_share_one_indices_buffer(self):
+        country_id, country_code = country_tag_arrays('de', 1000)
+        other_id, other_code = country_tag_arrays('us', 10)
+
+        self.assertEqual(country_id.to_pylist(), [2] * 1000)
+        self.assertEqual(other_code.to_pylist(), ['us'] * 10)
+        self.assertEqual(country_id.indices.buffers()[1].address, other_code.indices.buffers()[1].address)
+
+    def test_empty_result_keeps_its_columns(self):
+        batch = rows_to_record_batch([], [Column('id', 20), Column('name', 25)], 'us')
+
+        self.assertEqual(batch.num_rows, 0)
+        self.assertEqual(batch.schema.names, ['_country_id', '_country_code', 'id', 'name'])
+
+
+class BulkLoadTests(SimpleTestCase):
+
+    def test_arrow_types_map_to_postgres_columns(self):
+        self.assertEqual(arrow_type_to_postgres(pa.int64()), 'bigint')
+        self.assertEqual(arrow_type_to_postgres(pa.float64()), 'double precision')
+        self.assertEqual(arrow_type_to_postgres(pa.timestamp('us', tz='UTC')), 'timestamp with time zone')
+        self.assertEqual(arrow_type_to_postgres(pa.dictionary(pa.int8(), pa.string())), 'text')
+        self.assertEqual(arrow_type_to_postgres(pa.list_(pa.int64())), 'jsonb')
+        self.assertEqual(arrow_type_to_postgres(pa.null()), 'text')
+
+    @patch('search.views.copy_to_db')
+    def test_save_table_to_db_streams_batches_into_catopus_schema(self, mock_copy_to_db):
+        batches = iter([pa.table({'value': [1, 2]})])
+
+        table_name = save_table_to_db(batches, 'my_table')
+
+        self.assertTrue(table_name.startswith('my_table_'))
+        mock_copy_to_db.assert_called_once_with(batches, table_name, schema='catopus')
+
+
+class ResultPageViewTests(TestCase):
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+
+        self.user = User.objects.create(username='pager', name='pager', last_login=timezone.now())
+        self.client = Client()
+        self.client.force_login(self.user)
+
+        buffer = BytesIO()
+        table = pa.table({'id': list(range(25)), 'value': [(i * 7) % 25 for i in range(25)]})
+        pq.write_table(table, buffer, row_group_size=10)
+        self.search_result = SearchResult(identifier='page-test', user=self.user, sql_query='SELECT 1', countries=['de'])
+        self.search_result.search_results_file.save('page-test.parquet', ContentFile(buffer.getvalue()))
+        self.page_url = reverse('search:result_page', args=['page-test'])
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    def test_page_is_read_by_offset_and_limit(self):
+        response = self.client.get(self.page_url, {'offset': 8, 'limit': 5})
+
+        self.assertEqual(response.status_code, 200)
+        page = response.json()
+        self.assertEqual(page['columns'], ['id', 'value'])
+        self.assertEqual([row[0] for row in page['rows']], [8, 9, 10, 11, 12])
+        self.assertEqual(page['total_rows'], 25)
+
+    def test_page_is_sorted_by_column(self):
+        response = self.client.get(self.page_url, {'offset': 0, 'limit': 3, 'sort': 'value', 'desc': '1'})
+
+        self.assertEqual([row[1] for row in response.json()['rows']], [24, 23, 22])
+
+    def test_page_is_sorted_by_country_tag(self):
+        buffer = BytesIO()
+        countries = pa.array(['uk', 'de', 'pl'] * 10).dictionary_encode()
+        pq.write_table(pa.table({'_country_code': countries, 'id': list(range(30))}), buffer, row_group_size=10)
+        search_result = SearchResult(identifier='tag-sort', user=self.user, sql_query='SELECT 1', countries=['de', 'pl', 'uk'])
+        search_result.search_results_file.save('tag-sort.parquet', ContentFile(buffer.getvalue()))
+
+        response = self.client.get(reverse('search:result_page', args=['tag-sort']),
+                                   {'offset': 8, 'limit': 4, 'sort': '_country_code'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([row[0] for row in response.json()['rows']], ['de', 'de', 'pl', 'pl'])
+
+    def test_page_reads_only_the_requested_columns(self):
+        response = self.client.get(self.page_url, {'offset': 0, 'limit': 3, 'sort': 'value', 'columns': 'id'})
+
+        page = response.json()
+        self.assertEqual(page['columns'], ['id'])
+        self.assertEqual(page['rows'], [[0], [18], [11]])
+
+        self.assertEqual(self.client.get(self.page_url, {'columns': 'id,missing'}).status_code, 400)
+
+    def test_unknown_sort_column_is_rejected(self):
+        response = self.client.get(self.page_url, {'sort': 'missing'})
+
+        self.assertEqual(response.status_code, 400)
+
+    def test_page_in_columnar_format(self):
+        response = self.client.get(self.page_url, {'offset': 20, 'limit': 10, 'format': 'columns'})
+
+        page = response.json()
+        self.assertEqual(page['schema'], [{'name': 'id', 'type': 'int64'}, {'name': 'value', 'type': 'int64'}])
+        self.assertEqual(page['columns'][0], [20, 21, 22, 23, 24])
+        self.assertEqual(page['num_rows'], 5)
+
+    @override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+    def test_shared_result_embeds_the_first_page(self):
+        response = self.client.get(reverse('search:result', args=['page-test']))
+
+        self.assertEqual(response.context['result_page']['columns'][0][:3], [0, 1, 2])
+        self.assertContains(response, 'id="shared-result-page"')
+
+    def test_result_is_streamed_as_csv_arrow_and_parquet(self):
+        download_url = reverse('search:result_download', args=['page-test'])
+
+        csv_response = self.client.get(download_url, {'format': 'csv'})
+        lines = b''.join(csv_response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0], '"id","value"')
+        self.assertEqual(len(lines), 26)
+
+        arrow_response = self.client.get(download_url, {'format': 'arrow'})
+        table = pa.ipc.open_stream(b''.join(arrow_response.streaming_content)).read_all()
+        self.assertEqual(table.column('id').to_pylist(), list(range(25)))
+
+        parquet_response = self.client.get(download_url, {'format': 'parquet'})
+        self.search_result.search_results_file.open('rb')
+        self.assertEqual(b''.join(parquet_response.streaming_content), self.search_result.search_results_file.read())
+        self.search_result.search_results_file.close()
+        self.assertIn('page-test.parquet', parquet_response['Content-Disposition'])
+
+    def test_csv_export_writes_arrays_and_bytea_as_text(self):
+        buffer = BytesIO()
+        pq.write_table(pa.table({'tags': [['a', 'b'], None], 'raw': pa.array([b'\x01\xff', None])}), buffer)
+        search_result = SearchResult(identifier='csv-test', user=self.user, sql_query='SELECT 1', countries=['de'])
+        search_result.search_results_file.save('csv-test.parquet', ContentFile(buffer.getvalue()))
+
+        response = self.client.get(reverse('search:result_download', args=['csv-test']), {'format': 'csv'})
+
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines, ['"tags","raw"', '"[""a"", ""b""]","\\x01ff"', ','])
+
+    def test_result_is_streamed_as_xlsx(self):
+        response = self.client.get(reverse('search:result_download', args=['page-test']), {'format': 'xlsx'})
+
+        self.assertTrue(b''.join(response.streaming_content).startswith(b'PK'))
+
+    def test_unknown_download_format_is_rejected(self):
+        response = self.client.get(reverse('search:result_download', args=['page-test']), {'format': 'pdf'})
+
+        self.assertEqual(response.status_code, 400)
+
+    def test_columnar_values_are_json_safe(self):
+        table = pa.table({'score': [1.5, float('nan'), None], 'raw': pa.array([b'\x01', None, b'\xff'])})
+
+        page = table_to_columns(table, 0, 3)
+
+        self.assertEqual(page['columns'], [[1.5, None, None], ['01', None, 'ff']])
+        self.assertEqual(page['schema'][1], {'name': 'raw', 'type': 'binary'})
+
+
+class ResultStorageTests(SimpleTestCase):
+
+    @override_settings(SEARCH_RESULT_STORAGE={'compression': 'zstd', 'row_group_size': 4})
+    def test_result_is_written_with_configured_codec_and_row_groups(self):
+        buffer = BytesIO()
+        write_result_table(pa.table({'value': list(range(10))}), buffer)
+
+        metadata = pq.ParquetFile(BytesIO(buffer.getvalue())).metadata
+        self.assertEqual(metadata.num_row_groups, 3)
+        self.assertEqual(metadata.row_group(0).column(0).compression, 'ZSTD')
+        self.assertTrue(metadata.row_group(0).column(0).is_stats_set)
+
+    def test_unknown_codec_is_rejected(self):
+        with self.assertRaises(ValueError):
+            parquet_write_options({'compression': 'bz2'})
+
+    @override_settings(SEARCH_RESULT_STORAGE={'row_group_size': 4})
+    def test_spool_spills_over_budget_and_writes_one_file(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, True)
+
+        with override_settings(MEDIA_ROOT=media_root), ResultSpool(budget=1) as spool:
+            spool.add(pa.table({'id': [1, 2, 3]}), 'de')
+            spool.add(pa.table({'id': [4, 5, 6]}), 'pl')
+            spool.add(pa.table({'id': [7], 'name': ['x']}), 'de')
+            spool.discard('pl')
+            spool.finish('de')
+            self.assertEqual(spool.memory_bytes, 0)
+            self.assertGreater(spool.spilled_bytes, 0)
+
+            buffer = BytesIO()
+            spool.write_parquet(buffer)
+
+        parquet = pq.ParquetFile(BytesIO(buffer.getvalue()))
+        self.assertEqual(parquet.num_row_groups, 1)
+        self.assertEqual(parquet.read().to_pydict(), {'id': [1, 2, 3, 7], 'name': [None, None, None, 'x']})
+        self.assertEqual(os.listdir(os.path.join(media_root, 'spill')), [])
+
+
+class ResultCacheTests(TestCase):
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+        caches['search_results'].clear()
+
+        self.user = User.objects.create(username='cacher', name='cacher', last_login=timezone.now())
+        self.client = Client()
+        self.client.force_login(self.user)
+
+        buffer = BytesIO()
+        pq.write_table(pa.table({'id': [1, 2, 3]}), buffer)
+        search_result = SearchResult(identifier='cached-run', user=self.user, sql_query='select id from t', countries=['de', 'fr'])
+        search_result.search_results_file.save('cached-run.parquet', ContentFile(buffer.getvalue()))
+
+        self.query_data = {'query': 'SELECT id\n  FROM t -- ids\n;', 'selected_countries': ['fr,de'], 'list_of_countries': 'fr,de'}
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    def test_fingerprint_ignores_formatting_and_country_order(self):
+        self.assertEqual(normalize_sql('SELECT id\n  FROM t -- ids\n;'), 'select id from t')
+        self.assertEqual(query_fingerprint('select id from t', ['de', 'fr']),
+                         query_fingerprint('SELECT  id FROM t;', ['fr', 'de']))
+        self.assertNotEqual(query_fingerprint("select 'A  B'", ['de']), query_fingerprint("select 'A B'", ['de']))
+
+    @patch('search.views.run_select')
+    def test_cached_result_is_reused(self, mock_run_select):
+        cache_result('select id from t', ['de', 'fr'], 'cached-run')
+
+        response = self.client.post(reverse('search:index'), data=self.query_data)
+
+        mock_run_select.assert_not_called()
+        data = response.json()
+        self.assertTrue(data['cached'])
+        self.assertEqual(data['total_rows'], 3)
+        self.assertEqual((data['failed'], data['timed_out']), ([], []))
+        reused = SearchResult.objects.get(identifier=data['identifier'])
+        self.assertEqual(reused.search_results_file.name, SearchResult.objects.get(identifier='cached-run').search_results_file.name)
+
+    @patch('search.views.run_select')
+    def test_results_with_missing_countries_are_not_cached(self, mock_run_select):
+        mock_run_select.side_effect = lambda *args, **kwargs: with_country_status(pa.table({'id': [4]}), {'fr': 'connection lost'}, {})
+
+        first = self.client.post(reverse('search:index'), data=self.query_data).json()
+        second = self.client.post(reverse('search:index'), data=self.query_data).json()
+
+        self.assertEqual(mock_run_select.call_count, 2)
+        self.assertEqual(first['failed'], ['fr'])
+        self.assertNotIn('cached', second)
+
+    @patch('search.views.run_select')
+    def test_force_refresh_runs_the_query(self, mock_run_select):
+        cache_result('select id from t', ['de', 'fr'], 'cached-run')
+        mock_run_select.return_value = pa.table({'id': [4]})
+
+        response = self.client.post(reverse('search:index'), data={**self.query_data, 'force_refresh': '1'})
+
+        mock_run_select.assert_called_once()
+        self.assertEqual(response.json()['total_rows'], 1)
+
+    @patch('search.views.run_select')
+    def test_query_timeout_reaches_run_select(self, mock_run_select):
+        mock_run_select.return_value = pa.table({'id': [4]})
+
+        self.client.post(reverse('search:index'), data={**self.query_data, 'force_refresh': '1', 'timeout': '30'})
+
+        self.assertEqual(mock_run_select.call_args.kwargs['timeout'], 30)
+
+    @patch('search.views.run_select')
+    def test_first_page_is_columnar_when_asked(self, mock_run_select):
+        mock_run_select.return_value = pa.table({'id': [4, 5]})
+
+        data = self.client.post(reverse('search:index'), data={**self.query_data, 'force_refresh': '1', 'format': 'columns'}).json()
+
+        self.assertNotIn('table_html', data)
+        self.assertEqual(data['page']['columns'], [[4, 5]])
+        self.assertEqual(data['page']['total_rows'], 2)
+
+
+class StreamingQueryTests(TestCase):
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root, SEARCH_RESULT_PAGE_SIZE=3)
+        self.settings_override.enable()
+        caches['search_results'].clear()
+
+        self.user = User.objects.create(username='streamer', name='streamer', last_login=timezone.now())
+        self.client = Client()
+        self.client.force_login(self.user)
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    def _events(self, response):
+        body = b''.join(response.streaming_content).decode()
+        events = []
+        for block in body.strip().split('\n\n'):
+            event, data = block.split('\n')
+            events.append((event[len('event: '):], json.loads(data[len('data: '):])))
+        return events
+
+    @patch('search.views.stream_select')
+    def test_countries_are_pushed_before_the_final_result(self, mock_stream_select):
+        mock_stream_select.return_value = iter([
+            ('batch', 'de', pa.record_batch({'id': [1, 2]})),
+            ('batch', 'fr', pa.record_batch({'id': [9]})),
+            ('batch', 'uk', pa.record_batch({'id': [3]})),
+            ('done', 'de', {'rows': 2, 'batches': 1, 'seconds': 0.1}),
+            ('failed', 'fr', 'relation "t" does not exist'),
+            ('batch', 'uk', pa.record_batch({'id': [4]})),
+            ('done', 'uk', {'rows': 2, 'batches': 2, 'seconds': 0.2}),
+        ])
+
+        response = self.client.post(reverse('search:index'), data={
+            'query': 'select id from t', 'selected_countries': ['de,fr,uk'], 'list_of_countries': 'x', 'stream': '1'})
+
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        events = self._events(response)
+        self.assertEqual([event for event, data in events], ['country', 'country', 'country', 'result'])
+        self.assertEqual(events[0][1]['preview']['rows'], [[1], [2]])
+        self.assertEqual(events[1][1]['status'], 'failed')
+        # only the rows still missing from the first page are previewed
+        self.assertEqual(events[2][1]['preview']['rows'], [[3]])
+
+        result = events[-1][1]
+        self.assertEqual(result['total_rows'], 4)
+        self.assertEqual(result['failed'], ['fr'])
+        self.assertTrue(SearchResult.objects.filter(identifier=result['identifier'], user=self.user).exists())
+
+    @override_settings(SEARCH_QUERY_MEMORY_BUDGET=1)
+    @patch('search.views.stream_select')
+    def test_batches_are_spooled_while_the_country_runs(self, mock_stream_select):
+        spooled = []
+
+        def events():
+            yield 'batch', 'de', pa.record_batch({'id': [1, 2]})
+            # spilled before the country is done, past the budget of 1 byte
+            spooled.append(os.listdir(os.path.join(self.media_root, 'spill')))
+            yield 'batch', 'de', pa.record_batch({'id': [3]})
+            yield 'done', 'de', {'rows': 3, 'batches': 2, 'seconds': 0.1}
+
+        mock_stream_select.return_value = events()
+
+        response = self.client.post(reverse('search:index'), data={
+            'query': 'select id from t', 'selected_countries': ['de'], 'list_of_countries': 'x', 'stream': '1'})
+        result = self._events(response)[-1][1]
+
+        self.assertEqual(len(spooled[0]), 1)
+        self.assertEqual(result['total_rows'], 3)
+
+
+def _run_country_pool():
+    with _country_pool(2) as pool:
+        return sorted(pool.map(abs, [-1, -2]))
+
+
+class RemoteExecutionTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='remote', name='remote', last_login=timezone.now())
+        self.client = Client()
+        self.client.force_login(self.user)
+
+    @patch('search.views.run_sql_query_remotely')
+    def test_remote_run_is_queued(self, mock_task):
+        mock_task.delay.return_value = MagicMock(id='task-1')
+
+        response = self.client.post(reverse('search:index'), data={
+            'query': 'select 1', 'selected_countries': ['de,fr'], 'list_of_countries': 'x', 'is_remote': 'remote_start'})
+
+        job_id = response.json()['job_id']
+        mock_task.delay.assert_called_once_with(job_id)
+        log_remote = RemoteLogs.objects.get(id=job_id)
+        self.assertEqual((log_remote.status, log_remote.task_id), ('queued', 'task-1'))
+
+        status = self.client.get(reverse('search:remote_status', args=[job_id])).json()
+        self.assertEqual([(country['country'], country['status']) for country in status['countries']],
+                         [('de', 'pending'), ('fr', 'pending')])
+
+    def _run_task(self, mock_exec_sql_multiproc, mock_copy_to_db):
+        def exec_sql_multiproc(info, batch_size, deadline=None, record=None):
+            if info['db_name'] == 'fr':
+                raise Exception('relation "t" does not exist')
+            yield rows_to_record_batch([(1,), (2,)], [Column('id', 23)], info['db_name'])
+            yield rows_to_record_batch([(3,)], [Column('id', 23)], info['db_name'])
+
+        mock_exec_sql_multiproc.side_effect = exec_sql_multiproc
+        loads = []
+        mock_copy_to_db.side_effect = lambda batches, table_name, schema, append=False: loads.append((list(batches), append))
+        log_remote = RemoteLogs.objects.create(user=self.user, status='queued', sql_query='select id from t',
+                                               countries=['de', 'fr', 'pl'])
+        for country in ['de', 'fr', 'pl']:
+            RemoteCountryProgress.objects.create(remote_log=log_remote, country=country)
+
+        run_sql_query_remotely(log_remote.id)
+
+        log_remote.refresh_from_db()
+        return log_remote, loads
+
+    @patch('search.tasks.copy_to_db')
+    @patch('search.tasks.exec_sql_multiproc')
+    def test_task_loads_each_country_as_it_finishes(self, mock_exec_sql_multiproc, mock_copy_to_db):
+        log_remote, loads = self._run_task(mock_exec_sql_multiproc, mock_copy_to_db)
+
+        self.assertEqual(log_remote.status, 'finished')
+        self.assertEqual(log_remote.step, '2 of 3 countries done, 1 failed, 2 loaded')
+        progress = {row.country: row for row in log_remote.country_progress.all()}
+        self.assertEqual((progress['de'].status, progress['de'].rows), ('loaded', 3))
+        self.assertEqual(progress['fr'].status, 'failed')
+        # the first country creates the table, the next ones are appended
+        self.assertEqual([append for batches, append in loads], [False, True])
+        self.assertEqual(pa.concat_tables(loads[0][0]).column('id').to_pylist(), [1, 2, 3])
+
+    @override_settings(REMOTE_STREAMING_INGEST=False)
+    @patch('search.tasks.copy_to_db')
+    @patch('search.tasks.exec_sql_multiproc')
+    def test_task_can_load_all_countries_at_the_end(self, mock_exec_sql_multiproc, mock_copy_to_db):
+        log_remote, loads = self._run_task(mock_exec_sql_multiproc, mock_copy_to_db)
+
+        self.assertEqual(log_remote.status, 'finished')
+        self.assertEqual(log_remote.step, '2 of 3 countries done, 1 failed')
+        self.assertEqual(len(loads), 1)
+        self.assertEqual(pa.concat_tables(loads[0][0]).num_rows, 6)
+
+    def test_country_pool_runs_in_a_celery_worker_process(self):
+        # celery's prefork workers are daemonic billiard processes, which can't start children
+        worker = billiard.Pool(1)
+        try:
+            self.assertEqual(worker.apply(_run_country_pool), [1, 2])
+        finally:
+            worker.terminate()
+
+    def test_status_of_other_users_run_is_not_found(self):
+        other = User.objects.create(username='other', name='other', last_login=timezone.now())
+        log_remote = RemoteLogs.objects.create(user=other, status='queued', sql_query='select 1', countries=['de'])
+
+        response = self.client.get(reverse('search:remote_status', args=[log_remote.id]))
+
+        self.assertEqual(response.status_code, 404)
+
+
+class QueryStatsTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='stats', name='stats', last_login=timezone.now())
+        for seconds in [1, 2, 3, 4, 100]:
+            CountryQueryStats.objects.create(user=self.user, source='query', country='de', cluster='nl',
+                                             status='done', total_seconds=seconds, execute_seconds=seconds)
+        CountryQueryStats.objects.create(user=self.user, source='query', country='us', cluster='us',
+                                         status='timeout', total_seconds=600, error_class='QueryCanceled')
+        CountryQueryStats.objects.create(user=self.user, source='query', country='de', cluster='nl',
+                                         status='cancelled', total_seconds=3)
+
+    def test_percentiles_per_country_and_cluster(self):
+        countries = {stats['country']: stats for stats in aggregate_country_stats('country')}
+
+        self.assertEqual(countries['de']['runs'], 6)
+        self.assertEqual((countries['de']['errors'], countries['de']['cancelled']), (0, 1))
+        self.assertEqual(countries['de']['p50_total'], 3)
+        self.assertGreater(countries['de']['p95_total'], 4)
+        self.assertEqual((countries['us']['errors'], countries['us']['timeouts']), (1, 1))
+        self.assertEqual([stats['cluster'] for stats in aggregate_country_stats('cluster')], ['us', 'nl'])
+
+    @override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+    def test_stats_page(self):
+        self.client.force_login(self.user)
+
+        response = self.client.get(reverse('search:query_stats'))
+
+        self.assertContains(response, 'countryStatsTable')
+
+
+class MetricsTests(TestCase):
+
+    def test_metrics_are_exposed(self):
+        response = self.client.get(reverse('search:metrics'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'catopus_search_fanout_seconds')
+        self.assertContains(response, 'catopus_search_cluster_in_flight')
+
+    def test_pool_and_cluster_stats_are_exposed(self):
+        registry = EngineRegistry(idle_timeout=None)
+        registry.get_engine('10.0.1.65', 'de', 'user', 'password')
+        cluster_scheduler.limiter('nl')
+
+        with patch('catopus.utils.database._registries', {'remote': registry}):
+            response = self.client.get(reverse('search:metrics'))
+        registry.dispose_all()
+
+        self.assertContains(response, 'catopus_db_pool_connections{database="de@10.0.1.65",pid=')
+        self.assertContains(response, 'catopus_db_pool_engine_requests_total{database="de@10.0.1.65"')
+        self.assertContains(response, 'catopus_search_cluster_limit{cluster="nl"')
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_metrics_token_is_required_when_set(self):
+        self.assertEqual(self.client.get(reverse('search:metrics')).status_code, 403)
+        response = self.client.get(reverse('search:metrics'), HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+
+
+@override_settings(HISTORY_PAGE_SIZE=2, STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class HistoryPaginationTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='historian', name='historian', last_login=timezone.now())
+        self.client.force_login(self.user)
+
+        same_time = timezone.now()
+        for i in range(5):
+            SearchResult.objects.create(identifier=f'run-{i}', user=self.user, sql_query=f'select {i} ' + 'x' * 500,
+                                        countries=['de'], search_results_file='search_results/none.parquet')
+        # ties on created_at are broken by id
+        SearchResult.objects.filter(identifier__in=['run-1', 'run-2', 'run-3']).update(created_at=same_time)
+
+    def test_history_pages_cover_every_run_once(self):
+        seen, cursor = [], None
+        while True:
+            response = self.client.get(reverse('search:history'), {'before': cursor} if cursor else {})
+            seen += [row['identifier'] for row in response.context['search_result']]
+            self.assertLessEqual(len(response.context['search_result']), 2)
+            cursor = response.context['next_cursor']
+            if cursor is None:
+                break
+
+        self.assertEqual(sorted(seen), [f'run-{i}' for i in range(5)])
+        self.assertEqual(len(response.context['search_result'][0]['sql_preview']), 200)
+
+    def test_history_is_filtered_by_country(self):
+        SearchResult.objects.filter(identifier='run-4').update(countries=['pl', 'us'])
+
+        response = self.client.get(reverse('search:history'), {'country': 'PL'})
+
+        self.assertEqual([row['identifier'] for row in response.context['search_result']], ['run-4'])
+        self.assertContains(response, 'pl, us')
+
+    def test_full_sql_is_loaded_on_demand(self):
+        response = self.client.get(reverse('search:history_sql', args=['run-3']))
+        self.assertEqual(response.json()['sql_query'], 'select 3 ' + 'x' * 500)
+
+        other = User.objects.create(username='other', name='other', last_login=timezone.now())
+        self.client.force_login(other)
+        self.assertEqual(self.client.get(reverse('search:history_sql', args=['run-3'])).status_code, 404)
+
+    def test_remote_pages_start_with_runs_not_updated_yet(self):
+        for i in range(3):
+            RemoteLogs.objects.create(user=self.user, status='finished', sql_query=f'select {i}', countries=['de'],
+                                      updated_on=timezone.now())
+        queued = RemoteLogs.objects.create(user=self.user, status='queued', sql_query='select 9', countries=['de'])
+
+        first = self.client.get(reverse('search:remote'))
+        second = self.client.get(reverse('search:remote'), {'before': first.context['next_cursor']})
+
+        self.assertEqual(first.context['remote_log'][0]['id'], queued.id)
+        ids = [row['id'] for row in first.context['remote_log']] + [row['id'] for row in second.context['remote_log']]
+        self.assertEqual(sorted(ids), sorted(RemoteLogs.objects.values_list('id', flat=True)))
+        self.assertIsNone(second.context['next_cursor'])
@@ -6,8 +6,15 @@ app_name = 'search'  # Define the app namespace here
 urlpatterns = [
     path('', views.index, name='index'),
     path('result/<str:identifier>/', views.share_results, name='result'),
+    path('result/<str:identifier>/page/', views.result_page, name='result_page'),
+    path('result/<str:identifier>/download/', views.download_result, name='result_download'),
     path('history/', views.history, name='history'),
+    path('history/<str:identifier>/sql/', views.history_sql, name='history_sql'),
     path('remote/', views.remote, name='remote'),
+    path('remote/<int:job_id>/sql/', views.remote_sql, name='remote_sql'),
+    path('remote/<int:job_id>/status/', views.remote_status, name='remote_status'),
+    path('stats/', views.query_stats, name='query_stats'),
+    path('metrics', views.metrics, name='metrics'),
     path('saved_scripts/', views.saved_scripts, name='saved_scripts'),
     path('python_etl/', views.python_etl, name='python_etl'),
     # path('run_bat_file/', views.run_bat_file, name='run_bat_file'), # Commented out as per request
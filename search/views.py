@@ -1,35 +1,69 @@
-import ast
 import base64
 import json
 import logging
 import os
+import tempfile
+import time
 import uuid
-from io import BytesIO
 
-import pandas as pd
+import pyarrow as pa
 # import winrm # Commented out as per request
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
-from django.core.files.base import ContentFile
-from django.http import Http404, JsonResponse
+from django.core.files.base import File
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import Http404, HttpResponse, HttpResponseForbidden, JsonResponse, StreamingHttpResponse
+from django.db.models.functions import Substr
 from django.shortcuts import render
 from django.utils import timezone
 from dotenv import load_dotenv
 
-from catopus.utils.database import create_db_sqlalchemy_engine
-
-from .models import RemoteLogs, SavedScripts, SearchResult
-from .multiprocessing import run_select
+from catopus.utils.database import copy_to_db
+
+from .models import RemoteCountryProgress, RemoteLogs, SavedScripts, SearchResult
+from .cache import cache_result, get_cached_result
+from .exports import EXPORT_FORMATS, XLSX_MAX_ROWS, export_result
+from .pagination import keyset_page
+from .multiprocessing import (concat_batches, country_status, run_select, save_result_to_dwh, stream_select,
+                              with_country_status)
+from .metrics import (DWH_LOAD_SECONDS, FANOUT_SECONDS, HTML_RENDER_SECONDS, PARQUET_WRITE_SECONDS,
+                      RESULT_BYTES, RESULT_ROWS, render_metrics)
+from .results import (ResultSpool, iter_row_groups, open_result_file, read_result_page, spill_root, table_to_columns,
+                      table_to_page)
 from .tasks import run_sql_query_remotely
+from .telemetry import aggregate_country_stats, collect_country_stats, save_country_stats
 
 load_dotenv()
 
 logger = logging.getLogger('search')
 
+# characters of the sql shown in the history/remote lists, the full query is loaded on demand
+SQL_PREVIEW_LENGTH = 200
+
 
 def _handle_remote_execution(request, query_field, selected_countries, list_of_countries):
-    run_sql_query_remotely(request.user, query_field, selected_countries, list_of_countries)
-    return JsonResponse({'status': 'processing', 'message': 'Remote execution started.'})
+    log_remote = RemoteLogs.objects.create(user=request.user,
+                                           status="queued",
+                                           sql_query=query_field,
+                                           countries_list=list_of_countries,
+                                           countries=selected_countries)
+    RemoteCountryProgress.objects.bulk_create(
+        RemoteCountryProgress(remote_log=log_remote, country=country) for country in selected_countries)
+
+    # the fan-out runs on a celery worker, the web worker only queues it
+    try:
+        task = run_sql_query_remotely.delay(log_remote.id)
+    except Exception as e:
+        logger.error(f"Could not queue remote run {log_remote.id}: {e}", exc_info=True)
+        log_remote.status = "error"
+        log_remote.log_field = f"Could not queue remote run: {e}"
+        log_remote.updated_on = timezone.now()
+        log_remote.save()
+        return JsonResponse({'status': 'error', 'message': 'Remote execution could not be started.'}, status=503)
+
+    log_remote.task_id = task.id
+    log_remote.save(update_fields=['task_id'])
+    return JsonResponse({'status': 'processing', 'message': 'Remote execution started.', 'job_id': log_remote.id})
 
 
 def _handle_save_table(request):
@@ -42,16 +76,14 @@ def _handle_save_table(request):
 
     try:
         search_result = SearchResult.objects.get(identifier=identifier, user=request.user)
-        parquet_file = search_result.search_results_file
-        parquet_file.open('rb') # Ensure file pointer is at the beginning
-        df_to_save = pd.read_parquet(BytesIO(parquet_file.read()))
-        parquet_file.close()
+        with open_result_file(search_result) as parquet:
+            if parquet.metadata.num_rows == 0:
+                logger.info(f"DataFrame for identifier {identifier} is empty. Nothing to save.")
+                return JsonResponse({'status': 'info', 'message': 'No data to save.'})
 
-        if df_to_save.empty:
-            logger.info(f"DataFrame for identifier {identifier} is empty. Nothing to save.")
-            return JsonResponse({'status': 'info', 'message': 'No data to save.'})
+            # feed the loader one row group at a time instead of reading the whole file
+            post_factum_table = save_table_to_db(iter_row_groups(parquet), customer_table_name)
 
-        post_factum_table = save_table_to_db(df_to_save, customer_table_name)
         logger.info(f"Table '{post_factum_table}' saved successfully for identifier {identifier}.")
         return JsonResponse({'post_factum_table': post_factum_table, 'status': 'success'})
     except SearchResult.DoesNotExist:
@@ -62,34 +94,69 @@ def _handle_save_table(request):
         return JsonResponse({'status': 'error', 'message': f'An error occurred: {str(e)}'}, status=500)
 
 
-def _handle_query_execution(request, query_field, selected_countries, list_of_countries):
-    customer_table_name = request.POST.get('custom_user_table_name')
-    result = run_select(query_field, selected_countries, customer_table_name)
+@HTML_RENDER_SECONDS.time()
+def _render_table_html(table):
+    # pandas only for the html rendering
+    return table.to_pandas().to_html(
+        justify="left",
+        index=False,
+        border=0,
+        classes="table table-hover table-sm",
+        table_id="results-table"
+    )
 
-    result_df = pd.DataFrame()
-    a_priori_table_name = None
 
-    if isinstance(result, tuple) and len(result) == 2:
-        result_df, a_priori_table_name = result
-    elif isinstance(result, pd.DataFrame):
-        result_df = result
-    else:
-        logger.error(f"Unexpected result type from run_select: {type(result)}")
-        # Potentially return an error response or an empty DataFrame response
-        return JsonResponse({'status': 'error', 'message': 'Failed to execute query.'}, status=500)
+def _first_page(request, table, total_rows):
+    # the page renders the columnar payload itself, other clients get the to_html table
+    if request.POST.get('format') == 'columns':
+        return {'page': table_to_columns(table, 0, total_rows)}
+    return {'table_html': _render_table_html(table)}
 
 
-    if result_df is None or result_df.empty:
-        logger.info(f"Query returned no results or an error occurred. Query: {query_field}, Countries: {selected_countries}")
-        # Return an empty table or a message, but ensure identifier is still part of it for consistency if needed later
-        # For now, returning render as original code did for empty df.
-        # Consider if JsonResponse with a specific status/message is better.
-        return render(request, 'search/index.html', {'message': 'No results found.'}) # Or JsonResponse
+def _cache_ttl(request):
+    try:
+        ttl = int(request.POST.get('cache_ttl', settings.SEARCH_RESULT_CACHE['ttl']))
+    except ValueError:
+        ttl = settings.SEARCH_RESULT_CACHE['ttl']
+    return max(0, min(ttl, settings.SEARCH_RESULT_CACHE['max_ttl']))
+
+
+def _cached_result_data(request, cached, query_field, selected_countries, list_of_countries):
+    cached_result, missing = cached
+    # a new history entry of this user that points to the already stored file
+    identifier = str(uuid.uuid4())
+    SearchResult.objects.create(
+        identifier=identifier,
+        user=request.user,
+        sql_query=query_field,
+        countries=selected_countries,
+        countries_list=list_of_countries,
+        search_results_file=cached_result.search_results_file.name
+    )
 
-    # Save the DataFrame to a compressed file
-    buffer = BytesIO()
-    result_df.to_parquet(buffer, compression='gzip')
-    buffer.seek(0)
+    page_size = settings.SEARCH_RESULT_PAGE_SIZE
+    with open_result_file(cached_result) as parquet:
+        total_rows = parquet.metadata.num_rows
+        first_page = _first_page(request, read_result_page(parquet, 0, page_size), total_rows)
+
+    logger.info(f"result cache: served {identifier} from {cached_result.identifier}")
+    return {
+        **first_page,
+        'identifier': identifier,
+        'table_name': None,
+        'total_rows': total_rows,
+        'page_size': page_size,
+        'cached': True,
+        'cached_at': cached_result.created_at,
+        'failed': missing['failed'],
+        'timed_out': missing['timed_out'],
+        'status': 'success'
+    }
+
+
+def _store_result(request, result_table, query_field, selected_countries, list_of_countries, a_priori_table_name, cache_ttl):
+    if isinstance(result_table, pa.Table):
+        result_table = ResultSpool.from_table(result_table)
 
     identifier = str(uuid.uuid4())
     search_result_instance = SearchResult(
@@ -99,38 +166,186 @@ def _handle_query_execution(request, query_field, selected_countries, list_of_co
         countries=selected_countries,
         countries_list=list_of_countries
     )
-    search_result_instance.search_results_file.save(f"{identifier}.parquet.gzip", ContentFile(buffer.getvalue()))
+    # Save the result to a compressed file, streamed from memory and the spilled files
+    with tempfile.TemporaryFile(dir=spill_root()) as result_file:
+        with PARQUET_WRITE_SECONDS.time():
+            result_table.write_parquet(result_file)
+        RESULT_ROWS.observe(result_table.num_rows)
+        RESULT_BYTES.observe(result_file.tell())
+        result_file.seek(0)
+        search_result_instance.search_results_file.save(f"{identifier}.parquet", File(result_file))
     # search_result_instance.save() # .save() is called by search_results_file.save() if instance is new
 
-    table_html = result_df.to_html(
-        justify="left",
-        index=False,
-        border=0,
-        classes="table table-hover table-sm",
-        table_id="results-table"
-    )
-    return JsonResponse({
-        'table_html': table_html,
+    # a partial result is not reused: the failed and timed out countries may well work next time
+    missing = country_status(result_table)
+    if not missing['failed'] and not missing['timed_out']:
+        cache_result(query_field, selected_countries, identifier, cache_ttl)
+
+    # only the first page is rendered, the rest is fetched page by page from result_page
+    page_size = settings.SEARCH_RESULT_PAGE_SIZE
+    return {
+        **_first_page(request, result_table.head(page_size), result_table.num_rows),
         'identifier': identifier,
         'table_name': a_priori_table_name if a_priori_table_name else None,
+        'total_rows': result_table.num_rows,
+        'page_size': page_size,
+        'failed': sorted(missing['failed']),
+        'timed_out': sorted(missing['timed_out']),
         'status': 'success'
-    })
+    }
+
+
+def _query_timeout(request):
+    # a run can ask for a shorter deadline than SEARCH_QUERY_TIMEOUT, not a longer one
+    try:
+        timeout = int(request.POST.get('timeout', settings.SEARCH_QUERY_TIMEOUT))
+    except ValueError:
+        timeout = settings.SEARCH_QUERY_TIMEOUT
+    return max(1, min(timeout, settings.SEARCH_QUERY_TIMEOUT))
+
+
+def _cached_lookup(request, query_field, selected_countries):
+    customer_table_name = request.POST.get('custom_user_table_name')
+    force_refresh = request.POST.get('force_refresh') in ('1', 'true', 'on')
+
+    # runs that also create a dwh table always go to the countries
+    if customer_table_name or force_refresh or not _cache_ttl(request):
+        return None
+    return get_cached_result(query_field, selected_countries)
+
+
+def _handle_query_execution(request, query_field, selected_countries, list_of_countries):
+    customer_table_name = request.POST.get('custom_user_table_name')
+
+    cached = _cached_lookup(request, query_field, selected_countries)
+    if cached is not None:
+        return JsonResponse(_cached_result_data(request, cached, query_field, selected_countries, list_of_countries))
+
+    with collect_country_stats() as country_stats:
+        result = run_select(query_field, selected_countries, customer_table_name, timeout=_query_timeout(request))
+
+    result_table = None
+    a_priori_table_name = None
+
+    if isinstance(result, tuple) and len(result) == 2:
+        result_table, a_priori_table_name = result
+    elif isinstance(result, (pa.Table, ResultSpool)):
+        result_table = result
+    else:
+        logger.error(f"Unexpected result type from run_select: {type(result)}")
+        # Potentially return an error response or an empty DataFrame response
+        return JsonResponse({'status': 'error', 'message': 'Failed to execute query.'}, status=500)
 
+    # a result without rows but with columns is still stored and shown with its header
+    if result_table is None or not result_table.schema.names:
+        logger.info(f"Query returned no results or an error occurred. Query: {query_field}, Countries: {selected_countries}")
+        # Return an empty table or a message, but ensure identifier is still part of it for consistency if needed later
+        # For now, returning render as original code did for empty df.
+        # Consider if JsonResponse with a specific status/message is better.
+        save_country_stats(country_stats, request.user)
+        return render(request, 'search/index.html', {'message': 'No results found.'}) # Or JsonResponse
+
+    try:
+        data = _store_result(request, result_table, query_field, selected_countries, list_of_countries,
+                             a_priori_table_name, _cache_ttl(request))
+    finally:
+        if isinstance(result_table, ResultSpool):
+            result_table.close()
+    save_country_stats(country_stats, request.user, data['identifier'])
+    return JsonResponse(data)
+
+
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, cls=DjangoJSONEncoder)}\n\n"
+
+
+def _stream_query_events(request, query_field, selected_countries, list_of_countries):
+    """
+    Server-sent events of a query run: one 'country' event per country as soon as it
+    finishes (row count, timing and, until the first page is full, a preview of its rows),
+    then a single 'result' event with the same data as the non-streaming response.
+    """
+    customer_table_name = request.POST.get('custom_user_table_name')
+    page_size = settings.SEARCH_RESULT_PAGE_SIZE
+    result_spool = ResultSpool()
+
+    try:
+        cached = _cached_lookup(request, query_field, selected_countries)
+        if cached is not None:
+            yield _sse('result', _cached_result_data(request, cached, query_field, selected_countries, list_of_countries))
+            return
+
+        preview_rows = 0
+        previews = {}  # db_name -> its first batches, only as many rows as the first page still needs
+        missing = {'failed': {}, 'timeout': {}}
+        country_stats = []
+        fanout_start = time.monotonic()
+        for event, db_name, payload in stream_select(query_field, selected_countries, timeout=_query_timeout(request),
+                                                     country_stats=country_stats):
+            if event == 'batch':
+                # straight into the spool, which spills to disk past the query memory budget
+                result_spool.add(payload, db_name)
+                preview = previews.setdefault(db_name, [])
+                wanted = page_size - preview_rows - sum(batch.num_rows for batch in preview)
+                if wanted > 0:
+                    preview.append(payload.slice(0, wanted))
+                continue
+
+            preview = previews.pop(db_name, [])
+            if event != 'done':
+                # partial rows of a failed or timed out country are dropped
+                result_spool.discard(db_name)
+                missing[event][db_name] = payload
+                yield _sse('country', {'country': db_name, 'status': event, 'message': payload})
+                continue
+
+            result_spool.finish(db_name)
+            data = {'country': db_name, 'status': 'done', 'rows': payload['rows'], 'seconds': round(payload['seconds'], 3)}
+            if preview and preview_rows < page_size:
+                table = concat_batches(preview).slice(0, page_size - preview_rows)
+                data['preview'] = table_to_page(table, preview_rows, None)
+                preview_rows += table.num_rows
+            yield _sse('country', data)
+        FANOUT_SECONDS.labels('stream').observe(time.monotonic() - fanout_start)
+
+        if not result_spool.schema.names:
+            logger.info(f"Query returned no results. Query: {query_field}, Countries: {selected_countries}")
+            message = 'No results found.'
+            if missing['timeout']:
+                message += f" Timed out: {', '.join(sorted(missing['timeout']))}."
+            save_country_stats(country_stats, request.user)
+            yield _sse('result', {'status': 'info', 'message': message})
+            return
+
+        result_table = with_country_status(result_spool, missing['failed'], missing['timeout'])
+        a_priori_table_name = save_result_to_dwh(result_table, customer_table_name) \
+            if customer_table_name and result_table.num_rows else None
+        data = _store_result(request, result_table, query_field, selected_countries, list_of_countries,
+                             a_priori_table_name, _cache_ttl(request))
+        save_country_stats(country_stats, request.user, data['identifier'])
+        yield _sse('result', data)
+    except Exception as e:
+        logger.error(f"Error streaming query results: {e}", exc_info=True)
+        yield _sse('result', {'status': 'error', 'message': 'An unexpected error occurred. Please try again.'})
+    finally:
+        result_spool.close()
 
-def save_table_to_db(result_df, table_name: str):
+
+def _handle_streaming_query(request, query_field, selected_countries, list_of_countries):
+    response = StreamingHttpResponse(
+        _stream_query_events(request, query_field, selected_countries, list_of_countries),
+        content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # nginx: pass events through as they are written
+    return response
+
+
+def save_table_to_db(batches, table_name: str):
     logger.info(f"User provides custom table name to save into db: {table_name}")
     db_table_name = str(table_name) + '_' + timezone.now().strftime("%Y%m%d_%H_%M_%S")
 
-    result_df.to_sql(
-        db_table_name,
-        con=create_db_sqlalchemy_engine(
-            settings.DATABASES['default']['HOST'],
-            settings.DATABASES['default']['NAME'],
-            settings.DATABASES['default']['USER'],
-            settings.DATABASES['default']['PASSWORD']),
-        schema='catopus',
-        index=False,
-        chunksize=10000)
+    with DWH_LOAD_SECONDS.labels('save').time():
+        copy_to_db(batches, db_table_name, schema='catopus')
     return db_table_name
 
 
@@ -159,6 +374,8 @@ def index(request):
                 if not query_field : # selected_countries can be empty for some queries
                     logger.warning("Missing query_field for query execution.")
                     return JsonResponse({'status': 'error', 'message': 'Query is required.'}, status=400)
+                if request.POST.get('stream') == '1':
+                    return _handle_streaming_query(request, query_field, selected_countries, list_of_countries)
                 return _handle_query_execution(request, query_field, selected_countries, list_of_countries)
 
         except Exception as e:
@@ -175,31 +392,102 @@ def index(request):
 def share_results(request, identifier):
     try:
         search_result = SearchResult.objects.get(identifier=identifier)
-        result_df = pd.read_parquet(BytesIO(search_result.search_results_file.read()))
-        selected_countries = ast.literal_eval(search_result.countries)
-
-        table_html = result_df.to_html(justify="left",
-                                       index=False,
-                                       border=0,
-                                       classes="table table-hover table-sm")
-        context = {'table_html': table_html, 
+        page_size = settings.SEARCH_RESULT_PAGE_SIZE
+        with open_result_file(search_result) as parquet:
+            total_rows = parquet.metadata.num_rows
+            result_page = table_to_columns(read_result_page(parquet, 0, page_size), 0, total_rows)
+        selected_countries = search_result.countries
+
+        context = {'result_page': result_page,
                    'identifier': identifier,
+                   'total_rows': total_rows,
+                   'page_size': page_size,
                    'input_query': search_result.sql_query,
                    'selected_countries': json.dumps(selected_countries)}
         
         return render(request, 'search/index.html', context)
     except SearchResult.DoesNotExist:
         raise Http404("Search result not found")
+
+
+@login_required
+def result_page(request, identifier):
+    try:
+        offset = int(request.GET.get('offset', 0))
+        limit = min(int(request.GET.get('limit', settings.SEARCH_RESULT_PAGE_SIZE)), settings.SEARCH_RESULT_MAX_PAGE_SIZE)
+    except ValueError:
+        return JsonResponse({'status': 'error', 'message': 'offset and limit must be integers.'}, status=400)
+    sort = request.GET.get('sort') or None
+    descending = request.GET.get('desc') in ('1', 'true')
+    # comma separated, only these columns are read from the file
+    columns = [column for column in request.GET.get('columns', '').split(',') if column] or None
+
+    try:
+        search_result = SearchResult.objects.get(identifier=identifier)
+        with open_result_file(search_result) as parquet:
+            page = read_result_page(parquet, offset, limit, sort=sort, descending=descending, columns=columns)
+            total_rows = parquet.metadata.num_rows
+    except SearchResult.DoesNotExist:
+        raise Http404("Search result not found")
+    except KeyError as e:
+        return JsonResponse({'status': 'error', 'message': f'Unknown column: {e.args[0]}'}, status=400)
+
+    to_page = table_to_columns if request.GET.get('format') == 'columns' else table_to_page
+    return JsonResponse({**to_page(page, max(0, offset), total_rows), 'status': 'success'})
     
 
+@login_required
+def download_result(request, identifier):
+    export_format = request.GET.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        return JsonResponse({'status': 'error', 'message': f'Unsupported format: {export_format}'}, status=400)
+
+    try:
+        search_result = SearchResult.objects.get(identifier=identifier)
+    except SearchResult.DoesNotExist:
+        raise Http404("Search result not found")
+
+    if export_format == 'xlsx':
+        with open_result_file(search_result) as parquet:
+            if parquet.metadata.num_rows > XLSX_MAX_ROWS:
+                return JsonResponse({'status': 'error',
+                                     'message': f'Too many rows for Excel ({parquet.metadata.num_rows}), download csv or parquet.'},
+                                    status=400)
+
+    content_type, extension = EXPORT_FORMATS[export_format]
+    response = StreamingHttpResponse(export_result(search_result, export_format), content_type=content_type)
+    response['Content-Disposition'] = f'attachment; filename="{identifier}.{extension}"'
+    if export_format == 'parquet':
+        response['Content-Length'] = search_result.search_results_file.size
+    return response
+
+
+def _country_filter(queryset, request):
+    # runs that touched a country (?country=de), answered by the GIN index on countries
+    country = request.GET.get('country', '').strip().lower()
+    return queryset.filter(countries__contains=[country]) if country else queryset
+
+
 @login_required
 def history(request):
-    search_log = SearchResult.objects.filter(user=request.user).order_by('-created_at').values('user_id', 'created_at', 'sql_query', 'countries_list', 'countries')
+    search_log = (_country_filter(SearchResult.objects.filter(user=request.user), request)
+                  .annotate(sql_preview=Substr('sql_query', 1, SQL_PREVIEW_LENGTH))
+                  .values('id', 'identifier', 'user_id', 'created_at', 'sql_preview', 'countries_list', 'countries'))
+    search_log, next_cursor = keyset_page(search_log, 'created_at', request.GET.get('before'))
 
-    context = {'search_result': search_log}
+    context = {'search_result': search_log, 'next_cursor': next_cursor, 'is_first_page': not request.GET.get('before'),
+               'country': request.GET.get('country', '')}
     return render(request, 'search/history.html', context)
 
 
+@login_required
+def history_sql(request, identifier):
+    search_result = SearchResult.objects.filter(identifier=identifier, user=request.user).values('sql_query').first()
+    if search_result is None:
+        raise Http404("Search result not found")
+    return JsonResponse({'sql_query': search_result['sql_query'], 'status': 'success'})
+
+
 # @login_required
 # def run_bat_file(request):
 #     if request.method == 'POST':
@@ -244,6 +532,29 @@ def history(request):
 #     return JsonResponse({'status': 'fail', 'error': 'Not a POST request'})
 
 
+@login_required
+def query_stats(request):
+    try:
+        days = int(request.GET.get('days', 7))
+    except ValueError:
+        days = 7
+
+    context = {'days': days,
+               'cluster_stats': aggregate_country_stats('cluster', days),
+               'country_stats': aggregate_country_stats('country', days)}
+    return render(request, 'search/query-stats.html', context)
+
+
+def metrics(request):
+    # scraped by prometheus, so no login: protected by METRICS_TOKEN when it is set
+    token = settings.METRICS_TOKEN
+    if token and request.headers.get('Authorization') != f"Bearer {token}":
+        return HttpResponseForbidden()
+
+    body, content_type = render_metrics()
+    return HttpResponse(body, content_type=content_type)
+
+
 @login_required
 def python_etl(request):
 
@@ -252,12 +563,43 @@ def python_etl(request):
 
 @login_required
 def remote(request):
-    remote_log = RemoteLogs.objects.filter(user_id=request.user).order_by('-updated_on').values('user_id', 'status', 'sql_query', 'table_name_created', 'log_field', 'countries_list', 'countries', 'run_on', 'updated_on')
+    remote_log = (_country_filter(RemoteLogs.objects.filter(user_id=request.user), request)
+                  .annotate(sql_preview=Substr('sql_query', 1, SQL_PREVIEW_LENGTH))
+                  .values('id', 'user_id', 'status', 'step', 'sql_preview', 'table_name_created', 'log_field', 'countries_list', 'countries', 'run_on', 'updated_on'))
+    remote_log, next_cursor = keyset_page(remote_log, 'updated_on', request.GET.get('before'))
 
-    context = {'remote_log': remote_log}
+    context = {'remote_log': remote_log, 'next_cursor': next_cursor, 'is_first_page': not request.GET.get('before'),
+               'country': request.GET.get('country', '')}
     return render(request, 'search/remote.html', context)
 
 
+@login_required
+def remote_sql(request, job_id):
+    log_remote = RemoteLogs.objects.filter(id=job_id, user=request.user).values('sql_query').first()
+    if log_remote is None:
+        raise Http404("Remote run not found")
+    return JsonResponse({'sql_query': log_remote['sql_query'], 'status': 'success'})
+
+
+@login_required
+def remote_status(request, job_id):
+    try:
+        log_remote = RemoteLogs.objects.get(id=job_id, user=request.user)
+    except RemoteLogs.DoesNotExist:
+        raise Http404("Remote run not found")
+
+    countries = log_remote.country_progress.order_by('country').values('country', 'status', 'rows', 'bytes', 'seconds', 'message')
+    return JsonResponse({
+        'job_id': log_remote.id,
+        'status': log_remote.status,
+        'step': log_remote.step,
+        'table_name_created': log_remote.table_name_created,
+        'log_field': log_remote.log_field,
+        'updated_on': log_remote.updated_on,
+        'countries': list(countries),
+    })
+
+
 @login_required
 def saved_scripts(request):
     if request.method == 'POST':